@@ -0,0 +1,131 @@
+# Synthetic dom0 setups for benchmarks of the USB proxy dom0 extension, built
+# from the stand-ins in qubesusbproxy/tests.py (no Xen, no running qubes
+# needed, only qubes-core-admin Python modules).
+import asyncio
+import os
+import sys
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# pylint: disable=wrong-import-position
+from qubes.device_protocol import DeviceAssignment, Port, VirtualDevice
+
+import qubesusbproxy.core3ext
+import qubesusbproxy.metrics
+from qubesusbproxy.core3ext import USBDevice
+from qubesusbproxy.tests import TestDeviceCollection, TestVM
+
+# don't write metrics of benchmark runs over the real ones
+qubesusbproxy.metrics.REGISTRY.path = None
+
+BACKEND = "sys-usb"
+
+
+def port_id(index: int) -> str:
+    """Port of *index*-th synthetic device, 15 ports per bus."""
+    return f"{index // 15 + 1}-{index % 15 + 1}"
+
+
+def device_qdb(index: int, attachment=None, port=None) -> dict:
+    """QubesDB entries of *index*-th synthetic device."""
+    ident = (port or port_id(index)).replace(".", "_")
+    path = f"/qubes-usb-devices/{ident}"
+    result = {
+        f"{path}/desc": (
+            f"1a0a:{index:04x} Vendor\\x20{index} "
+            f"Device\\x20{index} SN{index:06d}"
+        ).encode(),
+        f"{path}/interfaces": b":030101:080650:",
+        f"{path}/usb-ver": b"2",
+    }
+    if attachment:
+        result[f"{path}/connected-to"] = attachment.encode()
+    return result
+
+
+class Setup:
+    """
+    Extension with a backend exposing *n_devices* devices (every third of
+    them attached to some frontend) and *n_frontends* running frontends,
+    each with a single assignment, varied between full (port and device
+    identity), port-only and device-only, auto-attach or ask-to-attach.
+    """
+
+    # pylint: disable=too-few-public-methods
+    def __init__(self, n_devices: int, n_frontends: int):
+        self.n_devices = n_devices
+        self.n_frontends = n_frontends
+        qdb = {}
+        for i in range(n_devices):
+            attachment = f"front-{i % n_frontends}" if i % 3 == 0 else None
+            qdb.update(device_qdb(i, attachment))
+        self.backend = TestVM(qdb=qdb, name=BACKEND)
+        self.app = self.backend.app
+        self.app.domains[BACKEND] = self.backend
+        self.backend.devices["usb"] = TestDeviceCollection(
+            backend_vm=self.backend, devclass="usb"
+        )
+        self.backend.devices["usb"]._exposed.extend(
+            USBDevice(Port(self.backend, port_id(i), "usb"))
+            for i in range(n_devices)
+        )
+        dom0 = self.add_vm("dom0")
+        dom0.klass = "AdminVM"
+        self.frontends = [self.add_vm(f"front-{j}") for j in range(n_frontends)]
+        for j, front in enumerate(self.frontends):
+            front.devices["usb"]._assigned.append(self.make_assignment(j))
+
+        self.ext = qubesusbproxy.core3ext.USBDeviceExtension()
+        # like after loading qubes: device lists of running backends are known
+        self.ext.restored_cache = {}
+        # pylint: disable=protected-access
+        _, current_devices, _ = self.ext._index_devices(self.backend)
+        self.ext.devices_cache[BACKEND] = current_devices
+
+    def add_vm(self, name, qdb=None):
+        vm = TestVM(qdb or {}, name=name)
+        vm.app = self.app
+        vm.qid = len(self.app.domains) + 1
+        vm.virt_mode = "pvh"
+        vm.devices["usb"] = TestDeviceCollection(backend_vm=vm, devclass="usb")
+        self.app.domains[name] = vm
+        return vm
+
+    def make_assignment(self, index: int):
+        device = USBDevice(
+            Port(self.backend, port_id(index % self.n_devices), "usb")
+        )
+        kind = index % 3
+        if kind == 0:
+            virtual = VirtualDevice(device.port, device.device_id)
+        elif kind == 1:
+            virtual = VirtualDevice(device.port, "*")
+        else:
+            virtual = VirtualDevice(
+                Port(self.backend, "*", "usb"), device.device_id
+            )
+        mode = "ask-to-attach" if index % 5 == 0 else "auto-attach"
+        return DeviceAssignment(virtual, mode=mode)
+
+    def current_devices(self):
+        """Port to attachment mapping, like devices_cache of the backend."""
+        return {
+            dev.port_id: dev.attachment
+            for dev in self.ext.on_device_list_usb(self.backend, None)
+        }
+
+
+def _discard(coro):
+    """Replacement of asyncio.ensure_future, dropping the background work."""
+    if asyncio.iscoroutine(coro):
+        coro.close()
+    return mock.Mock()
+
+
+def no_background_tasks():
+    """
+    Don't start tasks the extension schedules in the background (attaches,
+    events for frontends), to measure only the handler itself.
+    """
+    return mock.patch("asyncio.ensure_future", side_effect=_discard)
@@ -0,0 +1,7 @@
+#!/bin/sh
+
+# announce USB proxy features supported by this template
+
+qvm-features-request supported-feature.usb-warmup=1
+qvm-features-request supported-feature.usb-bulk-attach=1
+qvm-features-request supported-feature.usb-attach-trace=1
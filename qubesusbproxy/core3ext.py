@@ -26,14 +26,18 @@ import collections
 import dataclasses
 import fcntl
 import grp
+import json
 import os
 import re
 import string
 import subprocess
 import sys
+import time
+import uuid
 
 import tempfile
-from typing import List, Optional, Dict, Tuple, Any
+import types
+from typing import List, Optional, Dict, Tuple, Any, Mapping, Set
 
 import qubes.exc
 from qubes.utils import sanitize_stderr_for_log
@@ -96,16 +100,81 @@ import qubes.devices
 import qubes.ext
 import qubes.vm.adminvm
 
+from qubesusbproxy import metrics
+from qubesusbproxy import profiling
+from qubesusbproxy import qdb
+from qubesusbproxy import registry
+
 usb_device_re = re.compile(r"^[0-9]+-[0-9]+(_[0-9]+)*$")
 # should match valid VM name
 usb_connected_to_re = re.compile(rb"^[a-zA-Z][a-zA-Z0-9_.-]*$")
 usb_device_hw_ident_re = re.compile(r"^[0-9a-f]{4}:[0-9a-f]{4} ")
+attach_span_name_re = re.compile(rb"^[a-z0-9-]{1,32}$")
 
 HWDATA_PATH = "/usr/share/hwdata"
 
+#: how many recent attach timing records to keep (see `AttachTrace`)
+ATTACH_TRACES = 100
+#: attaches taking longer (in seconds) are logged with their timing record
+SLOW_ATTACH = 2
+
+#: how long (in seconds) to remember an attachment of a device that
+#: disappeared, to attach it back if it re-appears (re-enumerates)
+REATTACH_WINDOW = 10
+
+#: QubesDB watch events of a backend arriving within this time (in seconds)
+#: after the first one are handled together, as a single device list change
+#: (can be changed with `QUBES_USBPROXY_QDB_WINDOW` environment variable of
+#: qubesd, in milliseconds, 0 disables it); it is not extended by further
+#: events, so it bounds the delay added to handling of a single change
+QDB_COALESCE_WINDOW = 0.02
+#: upper bound of the configured window (in seconds)
+QDB_COALESCE_WINDOW_MAX = 0.5
+
+#: device list rescans of a single backend allowed per second on average...
+RESCAN_RATE = 10
+#: ... and in a burst
+RESCAN_BURST = 30
+#: how often (in seconds) to log that a backend is still being throttled
+RESCAN_WARNING_INTERVAL = 60
+
+#: checkpoint of device caches (backend -> port -> frontend name), to not
+#: announce again devices that didn't change across qubesd restart (can be
+#: changed with `QUBES_USBPROXY_CACHE_STATE` environment variable of qubesd,
+#: an empty value disables it)
+CACHE_STATE_PATH = os.environ.get(
+    "QUBES_USBPROXY_CACHE_STATE", "/run/qubes/qubes-usb-proxy-devices.json"
+)
+#: how often (in seconds) at most to write the checkpoint
+CACHE_STATE_INTERVAL = 1
+try:
+    QDB_COALESCE_WINDOW = min(
+        float(os.environ["QUBES_USBPROXY_QDB_WINDOW"]) / 1000,
+        QDB_COALESCE_WINDOW_MAX,
+    )
+except (KeyError, ValueError):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class DeviceDescription:
+    """
+    Device data parsed from QubesDB of its backend, shared by all USBDevice
+    objects of the device (see `USBDevice.describe`).
+    """
+
+    #: desc and interfaces keys it was parsed from
+    untrusted_data: Tuple[Optional[bytes], Optional[bytes]]
+    #: like `USBDevice._load_desc_from_qubesdb` result, None without desc
+    desc: Optional[Mapping[str, str]]
+    #: None without interfaces
+    interfaces: Optional[Tuple[Any, ...]]
+
 
 class USBDevice(DeviceInfo):
     _usb_known_devices = None
+    #: parsed data of devices, backend name -> port_id -> description
+    _descriptions: Dict[str, Dict[str, DeviceDescription]] = {}
 
     # pylint: disable=too-few-public-methods
     def __init__(self, port: qubes.device_protocol.Port):
@@ -220,28 +289,99 @@ class USBDevice(DeviceInfo):
         """
         The parent device, if any.
 
-        A USB device has no parents.
+        For a device connected through a hub, it is the device at the hub
+        port, if the backend exposes it (USB hubs usually are not exposed).
+        Devices connected directly to a root hub have no parents.
+        """
+        parent_port_id = _parent_port_id(self.port_id)
+        if parent_port_id is None:
+            return None
+        if not qdb.list_keys(
+            self.backend_domain,
+            "/qubes-usb-devices/" + parent_port_id.replace(".", "_") + "/",
+        ):
+            return None
+        return USBDevice(Port(self.backend_domain, parent_port_id, "usb"))
+
+    @classmethod
+    def describe(cls, backend, port_id: str) -> DeviceDescription:
+        """
+        Parsed QubesDB data of the device of *backend* in *port_id*.
+
+        It is parsed (and sanitized) only when the data changes, and shared
+        by all the objects of the device, including those created by event
+        subscribers and assignment matching. The extension does that for new
+        devices in a thread, before announcing them.
+        """
+        path = "/qubes-usb-devices/" + port_id.replace(".", "_")
+        # either key may be missing
+        untrusted_data: Tuple[Optional[bytes], Optional[bytes]] = (
+            qdb.read(backend, path + "/desc"),
+            qdb.read(backend, path + "/interfaces"),
+        )
+        description, parsed = cls._describe(backend, port_id, untrusted_data)
+        metrics.cache_lookup("device-description", not parsed)
+        return description
+
+    @classmethod
+    def _describe(
+        cls,
+        backend,
+        port_id: str,
+        untrusted_data: Tuple[Optional[bytes], Optional[bytes]],
+    ) -> Tuple[DeviceDescription, bool]:
         """
-        return None
+        Description of the device of *backend* in *port_id* with
+        *untrusted_data* (desc and interfaces), parsed only if the data
+        differs from the known one. Return it, and whether it was parsed.
+
+        It doesn't read QubesDB, so it can be used from other threads.
+        """
+        known = cls._descriptions.get(backend.name, {}).get(port_id)
+        if known is not None and known.untrusted_data == untrusted_data:
+            return known, False
+        device = cls(Port(backend, port_id, "usb"))
+        description = DeviceDescription(
+            untrusted_data,
+            device._parse_desc(untrusted_data[0]),
+            device._parse_interfaces(untrusted_data[1]),
+        )
+        descriptions = cls._descriptions.setdefault(backend.name, {})
+        descriptions[port_id] = description
+        return description, True
+
+    @classmethod
+    def forget_descriptions(cls, backend: str, keep=()):
+        """Drop parsed data of devices of *backend*, except those in *keep*."""
+        descriptions = cls._descriptions.get(backend, {})
+        for port_id in set(descriptions) - set(keep):
+            del descriptions[port_id]
+        if not descriptions:
+            cls._descriptions.pop(backend, None)
 
     def _load_interfaces_from_qubesdb(self) -> List[DeviceInterface]:
         result = [DeviceInterface.unknown()]
         if not self.backend_domain.is_running():
             # don't cache this value
             return result
-        untrusted_interfaces: bytes = self.backend_domain.untrusted_qdb.read(
-            self._qdb_path + "/interfaces"
-        )
-        if not untrusted_interfaces:
+        interfaces = self.describe(self.backend_domain, self.port_id).interfaces
+        if interfaces is None:
             return result
-        self._interfaces = result = [
+        self._interfaces = result = list(interfaces)
+        return result
+
+    def _parse_interfaces(
+        self, untrusted_interfaces: Optional[bytes]
+    ) -> Optional[Tuple[DeviceInterface, ...]]:
+        if not untrusted_interfaces:
+            return None
+        return tuple(
             DeviceInterface(
                 self._sanitize(ifc, safe_chars=string.hexdigits), devclass="usb"
             )
             for ifc in untrusted_interfaces.split(b":")
             if ifc
-        ]
-        return result
+        )
 
     def _load_desc_from_qubesdb(self) -> Dict[str, str]:
         unknown = "unknown"
@@ -257,11 +397,25 @@ class USBDevice(DeviceInfo):
         if not self.backend_domain.is_running():
             # don't cache this value
             return result
-        untrusted_device_desc: bytes = self.backend_domain.untrusted_qdb.read(
-            self._qdb_path + "/desc"
-        )
-        if not untrusted_device_desc:
+        desc = self.describe(self.backend_domain, self.port_id).desc
+        if desc is None:
             return result
+        # Data successfully loaded, cache these values
+        self._vendor_id = desc["vendor ID"]
+        self._product_id = desc["product ID"]
+        self._vendor = desc["vendor"]
+        self._product = desc["product"]
+        self._manufacturer = desc["manufacturer"]
+        self._name = desc["name"]
+        self._serial = desc["serial"]
+        return dict(desc)
+
+    def _parse_desc(
+        self, untrusted_device_desc: Optional[bytes]
+    ) -> Optional[Mapping[str, str]]:
+        if not untrusted_device_desc:
+            return None
+        unknown = "unknown"
         try:
             (
                 untrusted_vend_prod_id,
@@ -283,24 +437,19 @@ class USBDevice(DeviceInfo):
             )
             untrusted_name = untrusted_device_desc.replace(b" ", b"_")
 
-        # Data successfully loaded, cache these values
-        self._vendor_id = result["vendor ID"] = self._sanitize(
-            untrusted_vendor_id
-        )
-        self._product_id = result["product ID"] = self._sanitize(
-            untrusted_product_id
-        )
+        result = {
+            "vendor ID": self._sanitize(untrusted_vendor_id),
+            "product ID": self._sanitize(untrusted_product_id),
+        }
         vendor, product = self._get_vendor_and_product_names(
-            self._vendor_id, self._product_id
+            result["vendor ID"], result["product ID"]
         )
-        self._vendor = result["vendor"] = self._sanitize(vendor.encode())
-        self._product = result["product"] = self._sanitize(product.encode())
-        self._manufacturer = result["manufacturer"] = self._sanitize(
-            untrusted_manufacturer
-        )
-        self._name = result["name"] = self._sanitize(untrusted_name)
-        self._name = result["serial"] = self._sanitize(untrusted_serial)
-        return result
+        result["vendor"] = self._sanitize(vendor.encode())
+        result["product"] = self._sanitize(product.encode())
+        result["manufacturer"] = self._sanitize(untrusted_manufacturer)
+        result["name"] = self._sanitize(untrusted_name)
+        result["serial"] = self._sanitize(untrusted_serial)
+        return types.MappingProxyType(result)
 
     def _sanitize(
         self, untrusted_device_desc: bytes, safe_chars: Optional[str] = None
@@ -344,8 +493,8 @@ class USBDevice(DeviceInfo):
     def attachment(self):
         if not self.backend_domain.is_running():
             return None
-        untrusted_connected_to = self.backend_domain.untrusted_qdb.read(
-            self._qdb_path + "/connected-to"
+        untrusted_connected_to = qdb.read(
+            self.backend_domain, self._qdb_path + "/connected-to"
         )
         if not untrusted_connected_to:
             return None
@@ -416,6 +565,7 @@ class USBDevice(DeviceInfo):
         # C class  class_name
         #       subclass  subclass_name         <-- single tab
         #               prog-if  prog-if_name   <-- two tabs
+        metrics.cache_lookup("usb-ids", cls._usb_known_devices is not None)
         if cls._usb_known_devices is not None:
             return cls._usb_known_devices
         result: Dict[str, Dict] = {}
@@ -453,6 +603,86 @@ class USBDevice(DeviceInfo):
         return cls._usb_known_devices
 
 
+def _parent_port_id(port_id: str) -> Optional[str]:
+    """
+    Port of the hub *port_id* is connected through ("1-1.2.3" -> "1-1.2"),
+    or None for ports of a root hub.
+    """
+    parent, sep, _ = port_id.rpartition(".")
+    return parent if sep else None
+
+
+def _port_pairs(frontends: Optional[Dict[str, Any]]) -> str:
+    """Space-separated `port_id=frontend` pairs ("1-1=work 1-2=personal")."""
+    return " ".join(
+        f"{port_id}={front_vm.name}"
+        for port_id, front_vm in sorted((frontends or {}).items())
+    )
+
+
+def _is_awake(vm) -> bool:
+    """Check if *vm* is running, and neither paused nor suspended."""
+    return vm.is_running() and vm.get_power_state() not in (
+        "Paused",
+        "Suspended",
+    )
+
+
+def _describe_all(backend, port_ids, data: Mapping[str, bytes]) -> int:
+    # runs in the thread pool: only the snapshot *data*, never QubesDB of the
+    # backend (its connection belongs to the event loop); returns the number
+    # of descriptions parsed
+    # pylint: disable=protected-access
+    parsed = 0
+    for port_id in port_ids:
+        path = "/qubes-usb-devices/" + port_id.replace(".", "_")
+        _, was_parsed = USBDevice._describe(
+            backend,
+            port_id,
+            (data.get(path + "/desc"), data.get(path + "/interfaces")),
+        )
+        parsed += was_parsed
+    return parsed
+
+
+def _load_cache_state() -> Dict[str, Dict[str, Optional[str]]]:
+    """Load device caches checkpointed by `_save_cache_state`."""
+    if not CACHE_STATE_PATH:
+        return {}
+    try:
+        with open(CACHE_STATE_PATH, encoding="utf-8") as state_file:
+            state = json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(state, dict):
+        return {}
+    return {
+        backend: devices
+        for backend, devices in state.items()
+        if isinstance(devices, dict)
+        and all(
+            isinstance(port_id, str)
+            and (frontend is None or isinstance(frontend, str))
+            for port_id, frontend in devices.items()
+        )
+    }
+
+
+def _save_cache_state(state: Dict[str, Dict[str, Optional[str]]]):
+    """Write device caches checkpoint, atomically."""
+    if not CACHE_STATE_PATH:
+        return
+    try:
+        with tempfile.NamedTemporaryFile(
+            "w", dir=os.path.dirname(CACHE_STATE_PATH), delete=False
+        ) as state_file:
+            json.dump(state, state_file)
+        os.rename(state_file.name, CACHE_STATE_PATH)
+    except OSError:
+        # only an optimization
+        pass
+
+
 class USBProxyNotInstalled(qubes.exc.QubesException):
     pass
 
@@ -461,6 +691,135 @@ class QubesUSBException(qubes.exc.QubesException):
     pass
 
 
+@dataclasses.dataclass
+class TokenBucket:
+    """
+    Rate limit of *rate* operations per second on average, allowing bursts
+    of up to *burst* operations.
+    """
+
+    rate: float
+    burst: float
+    tokens: float = dataclasses.field(init=False)
+    updated: float = dataclasses.field(init=False)
+    #: when the limit was last reported as exceeded
+    warned: Optional[float] = None
+
+    def __post_init__(self):
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """
+        Take a token if there is one, and return 0. Otherwise return how
+        long (in seconds) to wait for the next one.
+        """
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+@dataclasses.dataclass
+class AttachTrace:
+    """
+    Timing record of a single attach, with phases (spans) measured in dom0,
+    the frontend and the backend.
+
+    Each span is (side, name, start, duration), where start is a wall clock
+    time in microseconds (clocks of different qubes are synchronized only
+    roughly) and duration is in microseconds.
+    """
+
+    frontend: str
+    backend: str
+    port_id: str
+    trace_id: str = dataclasses.field(
+        default_factory=lambda: uuid.uuid4().hex[:16]
+    )
+    started: float = dataclasses.field(default_factory=time.time)
+    spans: List[Tuple[str, str, int, int]] = dataclasses.field(
+        default_factory=list
+    )
+    error: Optional[str] = None
+
+    def add_span(self, side: str, name: str, start: float, end: float):
+        """Record a phase between *start* and *end* (`time.time()` values)."""
+        self.spans.append(
+            (side, name, int(start * 1000000), int((end - start) * 1000000))
+        )
+
+    def add_remote_spans(self, side: str, untrusted_spans: bytes):
+        """
+        Record phases reported by a qube, as comma separated list of
+        NAME:START_US:DURATION_US.
+        """
+        for untrusted_span in untrusted_spans.split(b",")[:32]:
+            try:
+                untrusted_name, untrusted_start, untrusted_duration = (
+                    untrusted_span.split(b":")
+                )
+                start = int(untrusted_start)
+                duration = int(untrusted_duration)
+            except ValueError:
+                continue
+            if not attach_span_name_re.match(untrusted_name):
+                continue
+            self.spans.append((side, untrusted_name.decode(), start, duration))
+
+    @property
+    def duration(self) -> float:
+        """Duration of the whole attach (so far), in seconds."""
+        return time.time() - self.started
+
+    def __str__(self):
+        spans = ", ".join(
+            f"{side}/{name} {duration / 1000:.1f}ms"
+            for side, name, _start, duration in self.spans
+        )
+        return (
+            f"attach {self.backend}:{self.port_id} to {self.frontend} "
+            f"[{self.trace_id}]: {spans}"
+            + (f" ({self.error})" if self.error else "")
+        )
+
+
+def _parse_trace_line(untrusted_line: bytes, traces) -> bool:
+    """
+    Parse "trace BUSID TRACE_ID FRONTEND_SPANS BACKEND_SPANS" line reported
+    by `qubes.USBAttach`, and add spans to the matching trace from *traces*
+    (port_id -> AttachTrace).
+
+    Return True if it was a trace line.
+    """
+    untrusted_fields = untrusted_line.split()
+    if not untrusted_fields or untrusted_fields[0] != b"trace":
+        return False
+    if len(untrusted_fields) != 5:
+        return True
+    trace = traces.get(untrusted_fields[1].decode("ascii", errors="replace"))
+    if trace is None or untrusted_fields[2] != trace.trace_id.encode():
+        return True
+    trace.add_remote_spans("frontend", untrusted_fields[3])
+    trace.add_remote_spans("backend", untrusted_fields[4])
+    return True
+
+
+def _attach_error(returncode: int, untrusted_stdout, untrusted_stderr):
+    """Exception describing failed `qubes.USBAttach` call."""
+    if returncode == 127:
+        return USBProxyNotInstalled("qubes-usb-proxy not installed in the VM")
+    return QubesUSBException(
+        f"Device attach failed: {sanitize_stderr_for_log(untrusted_stdout)}"
+        f" {sanitize_stderr_for_log(untrusted_stderr)}"
+    )
+
+
 def modify_qrexec_policy(service, line, add):
     """
     Add/remove *line* to qrexec policy of a *service*.
@@ -512,9 +871,11 @@ def modify_qrexec_policy(service, line, add):
                 os.rename(policy_new.name, path)
             else:
                 os.remove(path)
+            metrics.POLICY_WRITES.inc()
         break
 
 
+@profiling.profile_handlers
 class USBDeviceExtension(qubes.ext.Extension):
 
     def __init__(self):
@@ -525,7 +886,47 @@ class USBDeviceExtension(qubes.ext.Extension):
             "/etc/qubes-rpc/qubes.USB"
         )
         self.devices_cache = collections.defaultdict(dict)
+        #: device cache being built at qubesd start, backend name -> task
+        self.cache_warmups: Dict[str, asyncio.Future] = {}
+        #: time from the extension load to all the device caches built
+        self.cache_ready: Optional[float] = None
+        self.created = time.monotonic()
+        #: checkpointed device caches, not verified yet, backend name ->
+        #: port_id -> frontend name (loaded at the first domain-load)
+        self.restored_cache: Optional[Dict[str, Dict[str, Optional[str]]]] = (
+            None
+        )
+        self.cache_state_write: Optional[asyncio.TimerHandle] = None
         self.autoattach_locks = collections.defaultdict(asyncio.Lock)
+        #: attachments ended by backend preparing for suspend,
+        #: (backend name, port_id) -> (backend, frontend, device_id)
+        self.suspended_attachments: Dict[Tuple[str, str], Tuple] = {}
+        #: device_id of attached devices, backend name -> port_id -> device_id
+        self.attached_device_ids: Dict[str, Dict[str, str]] = (
+            collections.defaultdict(dict)
+        )
+        #: attachments of recently removed devices,
+        #: (backend name, device_id) -> (frontend, time of removal, port_id)
+        self.recent_attachments: Dict[Tuple[str, str], Tuple] = {}
+        #: (backend name, port_id) of devices being attached back
+        self.reattaching = set()
+        #: detached devices the backend is still giving back to itself,
+        #: backend name -> port_ids
+        self.pending_releases: Dict[str, Set[str]] = {}
+        #: attaches waiting to be started together,
+        #: (frontend name, backend name) -> [(device, result future, trace)]
+        self.attach_batches: Dict[Tuple[str, str], List[Tuple]] = {}
+        #: timing records of recent attaches
+        self.attach_traces: collections.deque = collections.deque(
+            maxlen=ATTACH_TRACES
+        )
+        #: device list changes waiting for the end of the coalescing window,
+        #: backend name -> (timer handle, path of the latest change)
+        self.pending_qdb_changes: Dict[str, Tuple[Any, str]] = {}
+        #: rate limits of device list rescans, backend name -> TokenBucket
+        self.rescan_limits: Dict[str, TokenBucket] = {}
+        #: devices of backends, as of their last device list change
+        self.registry = registry.DeviceRegistry()
 
     async def _auto_attach_devices(self, vm):
         async with self.autoattach_locks[vm.uuid]:
@@ -564,24 +965,124 @@ class USBDeviceExtension(qubes.ext.Extension):
         """Initialize watching for changes"""
         # pylint: disable=unused-argument
         vm.watch_qdb_path("/qubes-usb-devices")
-        if event == "domain-load":
+        if event == "domain-load" and self.restored_cache is None:
+            self.restored_cache = _load_cache_state()
+        if event == "domain-load" and vm.is_running():
             # avoid building a cache on domain-init, as it isn't fully set yet,
-            # and definitely isn't running yet
-            current_devices = {
-                dev.port_id: dev.attachment
-                for dev in self.on_device_list_usb(vm, None)
-            }
-            self.devices_cache[vm.name] = current_devices
+            # and definitely isn't running yet; on domain-load build it in the
+            # background, concurrently for all the backends, not to delay
+            # qubesd start
+            self.cache_warmups[vm.name] = asyncio.ensure_future(
+                self._warm_up_cache(vm)
+            )
         else:
-            self.devices_cache[vm.name] = {}
+            # a new qube may reuse a name of a removed one
+            self.devices_cache.pop(vm.name, None)
+
+    async def _warm_up_cache(self, vm):
+        """
+        Build the device cache of *vm* (see `on_domain_init_load`). Device
+        list changes of *vm* arriving in the meantime wait for it.
+        """
+        start = time.monotonic()
+        try:
+            if await qdb.SNAPSHOTS.refresh(vm):
+                await self._prefetch_descriptions(vm)
+            elif qdb.SNAPSHOTS.data(vm) is None:
+                # reading its QubesDB directly would block qubesd, its
+                # devices are found with the first successful refresh
+                self._fall_back_to_restored(vm)
+                return
+            devices, current_devices, _ = self._index_devices(vm)
+            restored = self._restore_cache(vm)
+            if restored is None or restored == current_devices:
+                self.devices_cache[vm.name] = current_devices
+                self._remember_attachments(vm, devices, current_devices, {})
+            else:
+                # changed while qubesd wasn't running, announce the changes
+                # (and only them)
+                self.devices_cache[vm.name] = restored
+                self._handle_qdb_change(vm, "/qubes-usb-devices")
+        except Exception as e:  # pylint: disable=broad-except
+            vm.log.warning(f"Failed to build USB device cache: {e}")
+            self._fall_back_to_restored(vm)
+        finally:
+            self.cache_warmups.pop(vm.name, None)
+            self._cache_changed()
+            now = time.monotonic()
+            metrics.CACHE_WARMUP_SECONDS.observe(now - start)
+            if not self.cache_warmups and self.cache_ready is None:
+                self.cache_ready = now - self.created
+                metrics.CACHE_READY_SECONDS.observe(self.cache_ready)
+
+    def _fall_back_to_restored(self, vm):
+        """
+        Use the checkpointed device cache of *vm*, if any (and not used
+        already), when its devices couldn't be read at qubesd start, so the
+        first device list change handled later announces only what changed
+        since.
+        """
+        restored = self._restore_cache(vm)
+        if restored is not None:
+            self.devices_cache[vm.name] = restored
+
+    def _restore_cache(self, vm) -> Optional[Dict[str, Any]]:
+        """
+        Device cache of *vm* from the checkpoint, with frontends resolved to
+        qubes (or None if there is no checkpoint of it).
+        """
+        restored = (self.restored_cache or {}).pop(vm.name, None)
+        if restored is None:
+            return None
+        return {
+            port_id: (
+                vm.app.domains[frontend] if frontend in vm.app.domains else None
+            )
+            for port_id, frontend in restored.items()
+        }
+
+    def _cache_changed(self):
+        """Schedule checkpointing device caches, if not scheduled already."""
+        if self.cache_state_write is not None or not CACHE_STATE_PATH:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self.cache_state_write = loop.call_later(
+            CACHE_STATE_INTERVAL, self._write_cache_state
+        )
+
+    def _write_cache_state(self):
+        self.cache_state_write = None
+        if self.cache_warmups or self.cache_ready is None:
+            # caches are not complete yet (or never will be, like in a tool
+            # loading qubes.xml without running the event loop), don't
+            # overwrite the previous checkpoint with them
+            return
+        _save_cache_state(
+            {
+                backend: {
+                    port_id: getattr(frontend, "name", None)
+                    for port_id, frontend in devices.items()
+                }
+                for backend, devices in self.devices_cache.items()
+                if devices
+            }
+        )
 
     async def attach_and_notify(self, vm, assignment):
         # bypass DeviceCollection logic preventing double attach
         device = assignment.device
+        if (device.backend_domain.name, device.port_id) in self.reattaching:
+            # already being attached back to its previous frontend
+            return
         if assignment.mode.value == "ask-to-attach":
+            start = time.monotonic()
             allowed = await utils.confirm_device_attachment(
                 device, {vm: assignment}
             )
+            metrics.CONFIRMATION_SECONDS.observe(time.monotonic() - start)
             allowed = allowed.strip()
             if vm.name != allowed:
                 return
@@ -604,26 +1105,395 @@ class USBDeviceExtension(qubes.ext.Extension):
     def on_qdb_change(self, vm, event, path):
         """A change in QubesDB means a change in a device list."""
         # pylint: disable=unused-argument
-        current_devices = dict(
-            (dev.port_id, dev.attachment)
-            for dev in self.on_device_list_usb(vm, None)
+        metrics.QDB_EVENTS.inc()
+        pending = self.pending_qdb_changes.get(vm.name)
+        if pending is not None:
+            # a burst of changes (like a dock plugged in, or usb-export
+            # writing several keys), handle them all at once
+            metrics.QDB_EVENTS_COALESCED.inc()
+            self.pending_qdb_changes[vm.name] = (pending[0], path)
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None:
+            self._handle_qdb_change(vm, path)
+        elif QDB_COALESCE_WINDOW <= 0:
+            self._rescan(vm, path)
+        else:
+            handle = loop.call_later(
+                QDB_COALESCE_WINDOW, self._flush_qdb_change, vm
+            )
+            self.pending_qdb_changes[vm.name] = (handle, path)
+
+    def _flush_qdb_change(self, vm):
+        """Handle device list changes collected within coalescing window."""
+        _, path = self.pending_qdb_changes.pop(vm.name)
+        self._rescan(vm, path)
+
+    def _rescan(self, vm, path):
+        """
+        Handle a device list change of the backend *vm*, or postpone it
+        (and merge it with further changes) if the backend changes its
+        device list more often than `RESCAN_RATE` allows.
+        """
+        limit = self.rescan_limits.get(vm.name)
+        if limit is None:
+            limit = self.rescan_limits[vm.name] = TokenBucket(
+                RESCAN_RATE, RESCAN_BURST
+            )
+        wait = limit.take()
+        if not wait:
+            asyncio.ensure_future(self._refresh_and_handle(vm, path))
+            return
+        metrics.RESCANS_THROTTLED.inc(vm.name)
+        now = time.monotonic()
+        if limit.warned is None or now - limit.warned > RESCAN_WARNING_INTERVAL:
+            limit.warned = now
+            vm.log.warning(
+                "USB device list changes too frequent, "
+                f"handling at most {RESCAN_RATE} per second"
+            )
+        handle = asyncio.get_running_loop().call_later(
+            wait, self._flush_qdb_change, vm
         )
-        utils.device_list_change(self, current_devices, vm, path, USBDevice)
+        self.pending_qdb_changes[vm.name] = (handle, path)
 
-    @qubes.ext.handler("device-list:usb")
-    def on_device_list_usb(self, vm, event):
-        # pylint: disable=unused-argument
+    async def _refresh_and_handle(self, vm, path):
+        """
+        Read the device list of *vm* off the event loop, then handle it (with
+        the previous data, if the backend's QubesDB didn't answer in time).
+        Without any data of the backend yet, the change is not handled, and
+        the device list stays as it was until a refresh succeeds.
+        """
+        warmup = self.cache_warmups.get(vm.name)
+        if warmup is not None:
+            # compare with the initial state, not with an empty cache
+            await asyncio.wait([warmup])
+        if await qdb.SNAPSHOTS.refresh(vm):
+            await self._prefetch_descriptions(vm)
+        elif qdb.SNAPSHOTS.data(vm) is None:
+            # reading its QubesDB directly would block qubesd
+            return
+        self._handle_qdb_change(vm, path)
 
-        if not vm.is_running() or not hasattr(vm, "untrusted_qdb"):
+    async def _prefetch_descriptions(self, vm):
+        """
+        Parse data of new devices of *vm* (see `USBDevice.describe`) in a
+        thread, from the just refreshed QubesDB snapshot, so that handling of
+        the change (and subscribers of device-added events) finds it ready.
+        """
+        if not self._exposes_devices(vm):
+            return
+        port_ids = [dev.port_id for dev in self._scan_devices(vm)]
+        data = qdb.SNAPSHOTS.data(vm)
+        if not port_ids or data is None:
             return
+        parsed = await asyncio.get_running_loop().run_in_executor(
+            qdb.SNAPSHOTS.executor, _describe_all, vm, port_ids, data
+        )
+        metrics.CACHE_REQUESTS.inc("device-description", "miss", amount=parsed)
 
-        if (
-            isinstance(vm, qubes.vm.adminvm.AdminVM)
-            and not self.usb_proxy_installed_in_dom0
+    def _handle_qdb_change(self, vm, path):
+        qdb_reads = metrics.QDB_READS.value()
+        devices, current_devices, replaced = self._index_devices(vm)
+        added, attached, detached, removed = utils.compare_device_cache(
+            vm, self.devices_cache, current_devices
+        )
+        self._remember_suspended(vm, detached, removed)
+        self._check_releases(vm, detached, removed)
+        self._remember_attachments(vm, devices, current_devices, detached)
+        self._fire_device_list_change(
+            vm, added, attached, detached, removed, replaced - set(added)
+        )
+        # the diff-carrying device-list-change event is fired above
+        utils.device_list_change(self, current_devices, vm, None, USBDevice)
+        self._reattach_recent(vm, devices, current_devices, added)
+        metrics.QDB_READS_PER_EVENT.observe(
+            metrics.QDB_READS.value() - qdb_reads
+        )
+        # don't keep empty entries (created also by compare_device_cache) of
+        # qubes without USB devices
+        if not self.devices_cache.get(vm.name):
+            self.devices_cache.pop(vm.name, None)
+        if not self.attached_device_ids.get(vm.name):
+            self.attached_device_ids.pop(vm.name, None)
+        self._cache_changed()
+
+    def _fire_device_list_change(
+        self,
+        vm,
+        added=(),
+        attached=None,
+        detached=None,
+        removed=(),
+        replaced=(),
+    ):
+        """
+        Announce a change of the device list of backend *vm*, with what
+        changed: port_ids of *added*, *removed* and *replaced* devices (other
+        device in the same port), and of *attached* and *detached* ones (with
+        names of their frontends), and the generation of the change. Nothing
+        is fired if nothing changed.
+
+        Event arguments are strings: space-separated port_ids, and
+        `port_id=frontend` pairs for attached and detached devices.
+        """
+        if not (added or attached or detached or removed or replaced):
+            return
+        generation = self.registry.record(vm.name)
+        vm.fire_event(
+            "device-list-change:usb",
+            added=" ".join(sorted(added)),
+            removed=" ".join(sorted(removed)),
+            replaced=" ".join(sorted(replaced)),
+            attached=_port_pairs(attached),
+            detached=_port_pairs(detached),
+            generation=str(generation),
+        )
+
+    def _index_devices(self, vm):
+        """
+        Read the device list of backend *vm* into the registry (before
+        events about the change are sent, so their handlers already see the
+        new list).
+
+        Return devices (port_id -> device), their frontends (port_id -> qube
+        or None), and port_ids where another device replaced a known one.
+        """
+        scanned = {}
+        if self._exposes_devices(vm):
+            for dev in self._scan_devices(vm):
+                description = USBDevice.describe(vm, dev.port_id)
+                scanned[dev.port_id] = (dev, description.untrusted_data)
+        devices, replaced = self.registry.update(vm.name, scanned)
+        USBDevice.forget_descriptions(vm.name, keep=devices)
+        current_devices = {}
+        for port_id, dev in devices.items():
+            current_devices[port_id] = dev.attachment
+            self.registry.attach(vm.name, port_id, current_devices[port_id])
+        return devices, current_devices, replaced
+
+    def _registry_ready(self) -> bool:
+        """
+        Whether the registry has devices of all running backends (device
+        caches of backends running at qubesd start are built; without
+        loading qubes, like in tools using qubes.xml, it never is).
+        """
+        return self.restored_cache is not None and not self.cache_warmups
+
+    def _remember_attachments(self, vm, devices, current_devices, detached):
+        """
+        Keep device_id of devices attached from the backend *vm*, and
+        remember attachments of those that disappeared, so they can be
+        attached back if the device re-appears shortly
+        (see `_reattach_recent`).
+        """
+        device_ids = self.attached_device_ids[vm.name]
+        now = time.monotonic()
+        for port_id in list(device_ids):
+            if current_devices.get(port_id) is not None:
+                continue
+            device_id = device_ids.pop(port_id)
+            if port_id not in current_devices and port_id in detached:
+                self.recent_attachments[(vm.name, device_id)] = (
+                    detached[port_id],
+                    now,
+                    port_id,
+                )
+        for port_id, front_vm in current_devices.items():
+            if front_vm is not None and port_id not in device_ids:
+                device_ids[port_id] = devices[port_id].device_id
+        for key, (_, removed_at, _) in list(self.recent_attachments.items()):
+            if now - removed_at > REATTACH_WINDOW:
+                del self.recent_attachments[key]
+
+    def _reattach_recent(self, vm, devices, current_devices, added):
+        """
+        Attach re-appearing devices back to the frontend they were attached
+        to just before they disappeared, without going through assignments
+        and confirmation.
+
+        This is done only for devices re-appearing in the same port, or
+        having a serial number (otherwise another device of the same kind
+        would look the same), and only if no other running qube has the
+        device assigned and the frontend doesn't have it assigned with
+        ask-to-attach; otherwise the usual assignment logic decides.
+        """
+        for port_id in added:
+            if current_devices[port_id] is not None:
+                continue
+            device = devices[port_id]
+            entry = self.recent_attachments.pop(
+                (vm.name, device.device_id), None
+            )
+            if entry is None:
+                continue
+            front_vm, removed_at, old_port_id = entry
+            if port_id != old_port_id and device.serial in ("", "unknown"):
+                continue
+            if not _is_awake(front_vm):
+                continue
+            if any(
+                assignment.mode.value == "ask-to-attach"
+                and assignment.matches(device)
+                for assignment in get_assigned_devices(front_vm.devices["usb"])
+            ):
+                continue
+            if any(
+                assignment.matches(device)
+                for other in vm.app.domains
+                if other != front_vm and other.is_running()
+                for assignment in get_assigned_devices(other.devices["usb"])
+            ):
+                continue
+            self.reattaching.add((vm.name, port_id))
+            asyncio.ensure_future(
+                self._reattach(front_vm, device, time.monotonic() - removed_at)
+            )
+
+    async def _reattach(self, front_vm, device, gone_for):
+        start = time.monotonic()
+        try:
+            await self.on_device_attach_usb(
+                front_vm, "device-pre-attach:usb", device, {}
+            )
+            await front_vm.fire_event_async(
+                "device-attach:usb", device=device, options={}
+            )
+        except qubes.exc.QubesException as e:
+            front_vm.log.warning(
+                f"Failed to attach back re-appeared USB device {device}: {e}"
+            )
+        else:
+            front_vm.log.info(
+                f"Attached back re-appeared USB device {device} in "
+                f"{time.monotonic() - start:.3f}s (was gone for "
+                f"{gone_for:.3f}s)"
+            )
+        finally:
+            self.reattaching.discard(
+                (device.backend_domain.name, device.port_id)
+            )
+
+    def _remember_suspended(self, vm, detached, removed):
+        """
+        Remember attachments ended by the backend *vm* when preparing for
+        suspend, to restore them on resume.
+
+        `usb-detach-all` marks such devices with `x-suspended` key. The marker
+        is taken into account only for detaches not requested by dom0, and
+        devices are restored only to the frontend they were attached to
+        (according to dom0), so the backend cannot direct them anywhere else.
+        """
+        for port_id, front_vm in detached.items():
+            if port_id in removed:
+                continue
+            if not qdb.read(
+                vm,
+                f"/qubes-usb-devices/{port_id.replace('.', '_')}/x-suspended",
+            ):
+                continue
+            device = USBDevice(Port(vm, port_id, "usb"))
+            self.suspended_attachments[(vm.name, port_id)] = (
+                vm,
+                front_vm,
+                device.device_id,
+            )
+
+    def _check_releases(self, vm, detached, removed):
+        """
+        Follow devices detached from the backend *vm* until it gives them back
+        to itself (see `usb_release_device_async`, reporting it in
+        `x-release` key of the device), and log those it failed to.
+        """
+        pending = self.pending_releases.setdefault(vm.name, set())
+        pending.update(detached)
+        pending.difference_update(removed)
+        for port_id in list(pending):
+            state = qdb.read(
+                vm, f"/qubes-usb-devices/{port_id.replace('.', '_')}/x-release"
+            )
+            if state == b"pending":
+                continue
+            pending.discard(port_id)
+            if state == b"failed":
+                metrics.RELEASE_FAILURES.inc()
+                vm.log.warning(
+                    f"Failed to give detached USB device {port_id} back to "
+                    f"the backend, see its system journal"
+                )
+        if not pending:
+            del self.pending_releases[vm.name]
+
+    async def _restore_suspended(self, vm):
+        """
+        Restore attachments ended by suspend (see `_remember_suspended`),
+        where *vm* is either backend or frontend, and the other side is
+        already resumed too.
+        """
+        to_restore = []
+        for key, (backend, front_vm, device_id) in list(
+            self.suspended_attachments.items()
         ):
+            if vm not in (backend, front_vm):
+                continue
+            if not (_is_awake(backend) and _is_awake(front_vm)):
+                continue
+            del self.suspended_attachments[key]
+            to_restore.append(
+                self._restore_attachment(backend, front_vm, key[1], device_id)
+            )
+        if not to_restore:
+            return
+        start = time.monotonic()
+        restored = await asyncio.gather(*to_restore)
+        vm.log.info(
+            f"Restored {sum(restored)} of {len(restored)} USB attachments "
+            f"after resume in {time.monotonic() - start:.3f}s"
+        )
+
+    async def _restore_attachment(self, backend, front_vm, port_id, device_id):
+        device = USBDevice(Port(backend, port_id, "usb"))
+        # make sure it is still the same device, and not attached meanwhile
+        if device.device_id != device_id or device.attachment:
+            return False
+        try:
+            await self.on_device_attach_usb(
+                front_vm, "device-pre-attach:usb", device, {}
+            )
+        except qubes.exc.QubesException as e:
+            front_vm.log.warning(
+                f"Failed to restore USB device {device} after resume: {e}"
+            )
+            return False
+        await front_vm.fire_event_async(
+            "device-attach:usb", device=device, options={}
+        )
+        return True
+
+    def _exposes_devices(self, vm) -> bool:
+        if not vm.is_running() or not hasattr(vm, "untrusted_qdb"):
+            return False
+        # include dom0 devices only when usb-proxy is installed there
+        return self.usb_proxy_installed_in_dom0 or not isinstance(
+            vm, qubes.vm.adminvm.AdminVM
+        )
+
+    @qubes.ext.handler("device-list:usb")
+    def on_device_list_usb(self, vm, event):
+        # pylint: disable=unused-argument
+        if not self._exposes_devices(vm):
+            return
+        if self.registry.tracks(vm.name) or self._registry_ready():
+            yield from self.registry.devices(vm.name)
             return
+        yield from self._scan_devices(vm)
 
-        untrusted_dev_list = vm.untrusted_qdb.list("/qubes-usb-devices/")
+    def _scan_devices(self, vm):
+        """List devices of *vm* from QubesDB."""
+        untrusted_dev_list = qdb.list_keys(vm, "/qubes-usb-devices/")
         if not untrusted_dev_list:
             return
         # just get a list of devices, not its every property
@@ -643,9 +1513,12 @@ class USBDeviceExtension(qubes.ext.Extension):
         if not vm.is_running():
             return
 
-        if vm.untrusted_qdb.list(
-            "/qubes-usb-devices/" + port_id.replace(".", "_")
-        ):
+        if self.registry.tracks(vm.name) or self._registry_ready():
+            device = self.registry.get(vm.name, port_id)
+            if device is not None:
+                yield device
+            return
+        if qdb.list_keys(vm, "/qubes-usb-devices/" + port_id.replace(".", "_")):
             yield USBDevice(Port(vm, port_id, "usb"))
 
     @staticmethod
@@ -665,6 +1538,10 @@ class USBDeviceExtension(qubes.ext.Extension):
         if not vm.is_running():
             return
 
+        if self._registry_ready():
+            for dev in self.registry.attached_to(vm.name):
+                yield (dev, {})
+            return
         for dev in self.get_all_devices(vm.app):
             if dev.attachment == vm:
                 yield (dev, {})
@@ -689,10 +1566,94 @@ class USBDeviceExtension(qubes.ext.Extension):
             #       file=sys.stderr)
             return
 
-        if device.attachment:
-            raise qubes.exc.DeviceAlreadyAttached(
-                f"Device {device} already attached to {device.attachment}"
+        metrics.ATTACHES.inc()
+        start = time.monotonic()
+        try:
+            if device.attachment:
+                raise qubes.exc.DeviceAlreadyAttached(
+                    f"Device {device} already attached to {device.attachment}"
+                )
+
+            trace = AttachTrace(
+                vm.name, device.backend_domain.name, device.port_id
             )
+            error = await self._attach_batched(vm, device, trace)
+            if error is not None:
+                raise error
+        except qubes.exc.QubesException as e:
+            metrics.ATTACH_FAILURES.inc(type(e).__name__)
+            raise
+        finally:
+            metrics.ATTACH_SECONDS.observe(time.monotonic() - start)
+
+    async def _attach_batched(self, vm, device, trace):
+        """
+        Attach *device* to *vm* together with other devices of the same
+        backend requested for the same frontend at the same time (like on
+        auto-attach at qube start), so they can share a single
+        `qubes.USBAttach` call.
+
+        Return an exception (or None on success).
+        """
+        key = (vm.name, device.backend_domain.name)
+        batch = self.attach_batches.setdefault(key, [])
+        if any(dev.port_id == device.port_id for dev, _, _ in batch):
+            return qubes.exc.DeviceAlreadyAttached(
+                f"Device {device} is already being attached to {vm}"
+            )
+        result = asyncio.get_event_loop().create_future()
+        batch.append((device, result, trace))
+        if len(batch) == 1:
+            try:
+                # let other attaches started at the same time join the batch
+                await asyncio.sleep(0)
+            except asyncio.CancelledError:
+                for _, res, _ in batch:
+                    res.cancel()
+                raise
+            finally:
+                del self.attach_batches[key]
+            results = [res for _, res, _ in batch]
+            try:
+                await self._attach_usb_devices(
+                    vm,
+                    [dev for dev, _, _ in batch],
+                    results,
+                    [tr for _, _, tr in batch],
+                )
+            except asyncio.CancelledError:
+                for res in results:
+                    res.cancel()
+                raise
+            except Exception as e:  # pylint: disable=broad-except
+                for res in results:
+                    if not res.done():
+                        res.set_exception(e)
+        # cancelling one of the attaches must not cancel the result the
+        # batch sets
+        return await asyncio.shield(result)
+
+    async def _attach_usb_devices(self, vm, devices, results=None, traces=None):
+        """
+        Attach *devices* to *vm* concurrently, with a single pass of qrexec
+        policy changes for all of them. If the frontend supports it and all of
+        them are from the same backend, they are attached with a single
+        `qubes.USBAttach` call.
+
+        Return a list of exceptions (or None on success), one for each device.
+        If *results* (futures, one for each device) are given, each of them
+        is set to that value as soon as it is known. Timing of each attach
+        is recorded in *traces* (see `AttachTrace`), if given.
+        """
+        if results is None:
+            results = [
+                asyncio.get_event_loop().create_future() for _ in devices
+            ]
+        if traces is None:
+            traces = [
+                AttachTrace(vm.name, dev.backend_domain.name, dev.port_id)
+                for dev in devices
+            ]
 
         stubdom_qrexec = (
             vm.virt_mode == "hvm"
@@ -705,37 +1666,159 @@ class USBDeviceExtension(qubes.ext.Extension):
         if stubdom_qrexec:
             extra_kwargs["stubdom"] = True
 
-        # update the cache before the call, to avoid sending duplicated events
-        # (one on qubesdb watch and the other by the caller of this method)
-        self.devices_cache[device.backend_domain.name][device.port_id] = vm
+        # stubdomain has its own implementation of the frontend side, and
+        # the frontend reports results by busid only
+        bulk = (
+            len(devices) > 1
+            and not stubdom_qrexec
+            and len({dev.backend_domain.name for dev in devices}) == 1
+            and vm.features.check_with_template(
+                "supported-feature.usb-bulk-attach", False
+            )
+        )
+        remote_trace = not stubdom_qrexec and vm.features.check_with_template(
+            "supported-feature.usb-attach-trace", False
+        )
+        requests = [
+            f"{device.backend_domain.name} {device.port_id}"
+            + (f" {trace.trace_id}" if remote_trace else "")
+            + "\n"
+            for device, trace in zip(devices, traces)
+        ]
 
-        # set qrexec policy to allow this device
-        policy_line = f"{name} {device.backend_domain.name} allow,user=root\n"
-        modify_qrexec_policy(f"qubes.USB+{device.port_id}", policy_line, True)
+        policies = []
+        for device in devices:
+            # update the cache before the call, to avoid sending duplicated
+            # events (one on qubesdb watch and the other by the caller of
+            # this method)
+            self.devices_cache[device.backend_domain.name][device.port_id] = vm
+            # set qrexec policy to allow this device
+            policies.append(
+                (
+                    f"qubes.USB+{device.port_id}",
+                    f"{name} {device.backend_domain.name} allow,user=root\n",
+                )
+            )
+        start = time.time()
+        for service, policy_line in policies:
+            modify_qrexec_policy(service, policy_line, True)
+        for trace in traces:
+            trace.add_span("dom0", "policy", start, time.time())
         try:
             # and actual attach
-            try:
-                await vm.run_service_for_stdio(
-                    "qubes.USBAttach",
-                    user="root",
-                    input=f"{device.backend_domain.name} "
-                    f"{device.port_id}\n".encode(),
-                    **extra_kwargs,
-                )
-            except subprocess.CalledProcessError as e:
-                # pylint: disable=raise-missing-from
-                if e.returncode == 127:
-                    raise USBProxyNotInstalled(
-                        "qubes-usb-proxy not installed in the VM"
+            if bulk:
+                await self._run_usb_attach_bulk(vm, requests, results, traces)
+            else:
+                await asyncio.gather(
+                    *(
+                        self._run_usb_attach(
+                            vm, request, extra_kwargs, result, trace
+                        )
+                        for request, result, trace in zip(
+                            requests, results, traces
+                        )
                     )
-                raise QubesUSBException(
-                    f"Device attach failed: {sanitize_stderr_for_log(e.output)}"
-                    f" {sanitize_stderr_for_log(e.stderr)}"
                 )
         finally:
-            modify_qrexec_policy(
-                f"qubes.USB+{device.port_id}", policy_line, False
+            for service, policy_line in policies:
+                modify_qrexec_policy(service, policy_line, False)
+        errors = [result.result() for result in results]
+        attached = collections.defaultdict(dict)
+        for device, trace, error in zip(devices, traces, errors):
+            self._record_attach_trace(vm, trace, error)
+            if error is None:
+                self.registry.attach(
+                    device.backend_domain.name, device.port_id, vm
+                )
+                attached[device.backend_domain][device.port_id] = vm
+        for backend, ports in attached.items():
+            self._fire_device_list_change(backend, attached=ports)
+        return errors
+
+    def _record_attach_trace(self, vm, trace, error):
+        trace.add_span("dom0", "total", trace.started, time.time())
+        if error is not None:
+            trace.error = str(error)
+        self.attach_traces.append(trace)
+        if trace.duration > SLOW_ATTACH:
+            vm.log.info(f"Slow USB device {trace}")
+        else:
+            vm.log.debug(f"USB device {trace}")
+
+    @staticmethod
+    async def _run_usb_attach(vm, request, extra_kwargs, result, trace):
+        start = time.time()
+        try:
+            untrusted_stdout, _ = await vm.run_service_for_stdio(
+                "qubes.USBAttach",
+                user="root",
+                input=request.encode(),
+                **extra_kwargs,
             )
+        except subprocess.CalledProcessError as e:
+            result.set_result(_attach_error(e.returncode, e.output, e.stderr))
+        else:
+            result.set_result(None)
+            for untrusted_line in (untrusted_stdout or b"").splitlines():
+                _parse_trace_line(untrusted_line, {trace.port_id: trace})
+        finally:
+            trace.add_span("dom0", "qubes.USBAttach", start, time.time())
+
+    @staticmethod
+    async def _run_usb_attach_bulk(vm, requests, results, traces):
+        """
+        Attach several devices with one `qubes.USBAttach` call, which
+        reports the result of each of them on a separate line, as soon as
+        it is known.
+        """
+        pending = {
+            trace.port_id: (result, trace)
+            for result, trace in zip(results, traces)
+        }
+        traces_by_port = {trace.port_id: trace for trace in traces}
+        start = time.time()
+        proc = await vm.run_service(
+            "qubes.USBAttach",
+            user="root",
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        proc.stdin.write("".join(requests).encode())
+        await proc.stdin.drain()
+        proc.stdin.close()
+        untrusted_stderr = asyncio.ensure_future(proc.stderr.read())
+        while pending:
+            untrusted_line = await proc.stdout.readline()
+            if not untrusted_line:
+                break
+            if _parse_trace_line(untrusted_line, traces_by_port):
+                continue
+            # attached BUSID / failed BUSID EXIT_CODE
+            untrusted_status = untrusted_line.decode(
+                "ascii", errors="replace"
+            ).split()
+            if len(untrusted_status) < 2:
+                continue
+            result, trace = pending.pop(untrusted_status[1], (None, None))
+            if result is None:
+                continue
+            trace.add_span("dom0", "qubes.USBAttach", start, time.time())
+            if untrusted_status[0] == "attached":
+                result.set_result(None)
+            elif len(untrusted_status) == 3 and untrusted_status[2].isdigit():
+                result.set_result(
+                    _attach_error(int(untrusted_status[2]), b"", b"")
+                )
+            else:
+                result.set_result(_attach_error(1, b"", b""))
+        returncode = await proc.wait()
+        for result, trace in pending.values():
+            trace.add_span("dom0", "qubes.USBAttach", start, time.time())
+            result.set_result(
+                _attach_error(returncode or 1, b"", await untrusted_stderr)
+            )
+        untrusted_stderr.cancel()
 
     @qubes.ext.handler("device-pre-detach:usb")
     async def on_device_detach_usb(self, vm, event, port):
@@ -743,14 +1826,25 @@ class USBDeviceExtension(qubes.ext.Extension):
         if not vm.is_running() or vm.qid == 0:
             return
 
-        for attached, _options in self.on_device_list_attached(vm, event):
-            if attached.port == port:
-                break
-        else:
-            raise QubesUSBException(
-                f"Device {port} not connected to VM {vm.name}"
-            )
+        metrics.DETACHES.inc()
+        start = time.monotonic()
+        try:
+            for attached, _options in self.on_device_list_attached(vm, event):
+                if attached.port == port:
+                    break
+            else:
+                raise QubesUSBException(
+                    f"Device {port} not connected to VM {vm.name}"
+                )
+
+            await self._detach_usb_device(vm, attached)
+        except qubes.exc.QubesException as e:
+            metrics.DETACH_FAILURES.inc(type(e).__name__)
+            raise
+        finally:
+            metrics.DETACH_SECONDS.observe(time.monotonic() - start)
 
+    async def _detach_usb_device(self, vm, attached):
         # update the cache before the call, to avoid sending duplicated events
         # (one on qubesdb watch and the other by the caller of this method)
         backend = attached.backend_domain
@@ -768,6 +1862,13 @@ class USBDeviceExtension(qubes.ext.Extension):
                 f"Device detach failed: {sanitize_stderr_for_log(e.output)}"
                 f" {sanitize_stderr_for_log(e.stderr)}"
             )
+        # the backend gives the device back to itself in the background,
+        # follow it (see `_check_releases`)
+        self.pending_releases.setdefault(backend.name, set()).add(
+            attached.port_id
+        )
+        self.registry.attach(backend.name, attached.port_id, None)
+        self._fire_device_list_change(backend, detached={attached.port_id: vm})
 
     @qubes.ext.handler("device-pre-assign:usb")
     async def on_device_assign_usb(self, vm, event, device, options):
@@ -778,30 +1879,143 @@ class USBDeviceExtension(qubes.ext.Extension):
                 "USB device assignment does not support user options"
             )
 
+    async def warm_up_frontend(self, vm):
+        """
+        Prepare the frontend part of USB proxy in *vm* ahead of the first
+        attach (load vhci-hcd etc.).
+
+        The VM needs to announce `supported-feature.usb-warmup`, and it can
+        be disabled with `usb-warmup` feature set to an empty value.
+        Qubes with stubdom-qrexec are skipped, as the frontend runs
+        in the stubdomain then.
+        """
+        if not vm.features.check_with_template(
+            "supported-feature.usb-warmup", False
+        ):
+            return
+        if not vm.features.check_with_template("usb-warmup", True):
+            return
+        if vm.virt_mode == "hvm" and vm.features.check_with_template(
+            "stubdom-qrexec", False
+        ):
+            return
+        try:
+            await vm.run_service_for_stdio("qubes.USBWarmup", user="root")
+        except subprocess.CalledProcessError as e:
+            vm.log.warning(
+                "USB proxy warm-up failed: "
+                f"{sanitize_stderr_for_log(e.stderr)}"
+            )
+
     @qubes.ext.handler("domain-start")
     async def on_domain_start(self, vm, _event, **_kwargs):
         # pylint: disable=unused-argument
+        if any(True for _ in get_assigned_devices(vm.devices["usb"])):
+            # don't delay auto-attach, it loads modules by itself anyway
+            asyncio.ensure_future(self.warm_up_frontend(vm))
         await self._auto_attach_devices(vm)
 
     @qubes.ext.handler("domain-shutdown")
     async def on_domain_shutdown(self, vm, _event, **_kwargs):
         # pylint: disable=unused-argument
-        vm.fire_event("device-list-change:usb")
+        cache = self.devices_cache.get(vm.name, {})
+        self._fire_device_list_change(
+            vm,
+            removed=cache,
+            detached={
+                port_id: front_vm
+                for port_id, front_vm in cache.items()
+                if front_vm is not None
+            },
+        )
         # devices exposed by the shutting-down backend vm:
         # notify that they are gone and detach them from frontend vms
         utils.device_list_change(self, {}, vm, None, USBDevice)
         # devices attached to shutting-down frontend vm: notify detach
+        for backend_name, devices in list(self.devices_cache.items()):
+            detached = {
+                port_id: front_vm
+                for port_id, front_vm in devices.items()
+                if front_vm == vm
+            }
+            if detached and backend_name in vm.app.domains:
+                self._fire_device_list_change(
+                    vm.app.domains[backend_name], detached=detached
+                )
         utils.detach_attached_devices_on_shutdown(self, vm, USBDevice)
-        if vm.uuid in self.autoattach_locks:
-            del self.autoattach_locks[vm.uuid]
+        self._forget_domain(vm.name, vm.uuid)
+        self._cache_changed()
+
+    @qubes.ext.handler("domain-delete", system=True)
+    def on_domain_delete(self, app, event, vm, **kwargs):
+        # pylint: disable=unused-argument
+        self._forget_domain(vm.name, vm.uuid)
+        self._cache_changed()
+
+    @qubes.ext.handler("property-set:name")
+    def on_domain_rename(self, vm, event, name, newvalue, oldvalue=None):
+        # pylint: disable=unused-argument
+        if oldvalue is not None:
+            self._forget_domain(oldvalue)
+            self._cache_changed()
+
+    def _forget_domain(self, name, vm_uuid=None):
+        """
+        Drop everything kept about a qube named *name* (and with *vm_uuid*),
+        when it shuts down, or is removed or renamed.
+        """
+        pending = self.pending_qdb_changes.pop(name, None)
+        if pending is not None:
+            pending[0].cancel()
+        warmup = self.cache_warmups.pop(name, None)
+        if warmup is not None:
+            warmup.cancel()
+        self.rescan_limits.pop(name, None)
+        self.pending_releases.pop(name, None)
+        qdb.SNAPSHOTS.forget(name)
+        self.registry.forget(name)
+        USBDevice.forget_descriptions(name)
+        self.devices_cache.pop(name, None)
+        self.attached_device_ids.pop(name, None)
+        if self.restored_cache:
+            self.restored_cache.pop(name, None)
+        if vm_uuid is not None:
+            self.autoattach_locks.pop(vm_uuid, None)
+        for key, (backend, front_vm, _) in list(
+            self.suspended_attachments.items()
+        ):
+            if name in (backend.name, front_vm.name):
+                del self.suspended_attachments[key]
+        for key, (front_vm, _, _) in list(self.recent_attachments.items()):
+            if name in (key[0], front_vm.name):
+                del self.recent_attachments[key]
 
     @qubes.ext.handler("domain-resumed")
     async def on_domain_resumed(self, vm, _event, **_kwargs):
         # pylint: disable=unused-argument
+        # restore first, auto-attach skips already attached devices
+        await self._restore_suspended(vm)
         await self._auto_attach_devices(vm)
 
     @qubes.ext.handler("qubes-close", system=True)
     def on_qubes_close(self, app, event):
         # pylint: disable=unused-argument
+        for handle, _ in self.pending_qdb_changes.values():
+            handle.cancel()
+        self.pending_qdb_changes.clear()
+        for warmup in self.cache_warmups.values():
+            warmup.cancel()
+        self.cache_warmups.clear()
+        if self.cache_state_write is not None:
+            self.cache_state_write.cancel()
+        self._write_cache_state()
+        self.rescan_limits.clear()
+        self.pending_releases.clear()
+        qdb.SNAPSHOTS.clear()
+        self.registry.clear()
         self.devices_cache.clear()
         self.autoattach_locks.clear()
+        self.suspended_attachments.clear()
+        self.attached_device_ids.clear()
+        self.recent_attachments.clear()
+        metrics.REGISTRY.write()
@@ -0,0 +1,255 @@
+# coding=utf-8
+#
+# The Qubes OS Project, https://www.qubes-os.org
+#
+# Copyright (C) 2026  The Qubes OS Project contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+"""
+Metrics of the USB proxy extension, exported in Prometheus text format.
+
+The file (`METRICS_PATH`, can be changed with `QUBES_USBPROXY_METRICS`
+environment variable of qubesd, empty value disables it) is rewritten at
+most every `WRITE_INTERVAL` seconds, when some metric changed. It can be
+collected for example with node_exporter textfile collector.
+"""
+
+import asyncio
+import os
+import tempfile
+from typing import Dict, Iterable, List, Optional, Tuple
+
+METRICS_PATH = os.environ.get(
+    "QUBES_USBPROXY_METRICS", "/var/run/qubes/qubes-usb-proxy.prom"
+)
+WRITE_INTERVAL = 5
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    labels = ",".join(
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values)
+    )
+    return "{" + labels + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    """Monotonically increasing value, optionally split by labels."""
+
+    type = "counter"
+
+    def __init__(self, registry, name, documentation, labels=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+        self.registry.changed()
+
+    def value(self, *label_values: str) -> float:
+        return self.values.get(label_values, 0)
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        for label_values, value in sorted(self.values.items()):
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    """Distribution of observed values, in cumulative buckets."""
+
+    type = "histogram"
+
+    def __init__(self, registry, name, documentation, buckets):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.counts: List[int] = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.registry.changed()
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield self.name + "_bucket", f'{{le="{bound:g}"}}', cumulative
+        yield self.name + "_bucket", '{le="+Inf"}', self.count
+        yield self.name + "_sum", "", self.sum
+        yield self.name + "_count", "", self.count
+
+
+class Registry:
+    """Set of metrics, written together to a file."""
+
+    def __init__(self, path: Optional[str] = METRICS_PATH):
+        self.path = path
+        self.metrics: List = []
+        self._write_scheduled = False
+
+    def counter(self, name, documentation, labels=()) -> Counter:
+        metric = Counter(self, name, documentation, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, buckets) -> Histogram:
+        metric = Histogram(self, name, documentation, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Return all the metrics in Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """Write metrics to the file, atomically."""
+        self._write_scheduled = False
+        if not self.path:
+            return
+        try:
+            with tempfile.NamedTemporaryFile(
+                "w", dir=os.path.dirname(self.path), delete=False
+            ) as metrics_file:
+                metrics_file.write(self.render())
+            os.chmod(metrics_file.name, 0o644)
+            os.rename(metrics_file.name, self.path)
+        except OSError:
+            # metrics are not worth failing anything else
+            pass
+
+    def changed(self):
+        """Schedule writing the file, if not scheduled already."""
+        if self._write_scheduled or not self.path:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # not running in qubesd (like in unit tests)
+            return
+        self._write_scheduled = True
+        loop.call_later(WRITE_INTERVAL, self.write)
+
+
+REGISTRY = Registry()
+
+ATTACHES = REGISTRY.counter(
+    "qubes_usbproxy_attaches_total", "Attach requests handled"
+)
+ATTACH_FAILURES = REGISTRY.counter(
+    "qubes_usbproxy_attach_failures_total",
+    "Failed attach requests, by exception type",
+    ("exception",),
+)
+ATTACH_SECONDS = REGISTRY.histogram(
+    "qubes_usbproxy_attach_seconds",
+    "Duration of attach requests",
+    (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+DETACHES = REGISTRY.counter(
+    "qubes_usbproxy_detaches_total", "Detach requests handled"
+)
+DETACH_FAILURES = REGISTRY.counter(
+    "qubes_usbproxy_detach_failures_total",
+    "Failed detach requests, by exception type",
+    ("exception",),
+)
+DETACH_SECONDS = REGISTRY.histogram(
+    "qubes_usbproxy_detach_seconds",
+    "Duration of detach requests",
+    (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+QDB_EVENTS = REGISTRY.counter(
+    "qubes_usbproxy_qdb_events_total",
+    "QubesDB watch events of device lists received",
+)
+QDB_EVENTS_COALESCED = REGISTRY.counter(
+    "qubes_usbproxy_qdb_events_coalesced_total",
+    "QubesDB watch events merged into an already pending device list change",
+)
+RESCANS_THROTTLED = REGISTRY.counter(
+    "qubes_usbproxy_rescans_throttled_total",
+    "Device list rescans postponed by the rate limit, by backend",
+    ("backend",),
+)
+RELEASE_FAILURES = REGISTRY.counter(
+    "qubes_usbproxy_release_failures_total",
+    "Detached devices the backend failed to give back to itself",
+)
+QDB_READS = REGISTRY.counter(
+    "qubes_usbproxy_qdb_reads_total",
+    "QubesDB reads and lists of USB devices made (not served from snapshots)",
+)
+QDB_READS_PER_EVENT = REGISTRY.histogram(
+    "qubes_usbproxy_qdb_reads_per_event",
+    "QubesDB reads made while handling a device list change (after the "
+    "snapshot refresh)",
+    (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+QDB_TIMEOUTS = REGISTRY.counter(
+    "qubes_usbproxy_qdb_timeouts_total",
+    "QubesDB reads of a backend not finished in time, by backend",
+    ("backend",),
+)
+CACHE_REQUESTS = REGISTRY.counter(
+    "qubes_usbproxy_cache_requests_total",
+    "Lookups of cached device data, by cache and result (hit/miss)",
+    ("cache", "result"),
+)
+CACHE_WARMUP_SECONDS = REGISTRY.histogram(
+    "qubes_usbproxy_cache_warmup_seconds",
+    "Time to build the device cache of a backend at qubesd start",
+    (0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10),
+)
+CACHE_READY_SECONDS = REGISTRY.histogram(
+    "qubes_usbproxy_cache_ready_seconds",
+    "Time from extension load to device caches of all backends built",
+    (0.1, 0.5, 1, 2, 5, 10, 30, 60),
+)
+POLICY_WRITES = REGISTRY.counter(
+    "qubes_usbproxy_policy_writes_total", "Changes of qrexec policy files"
+)
+CONFIRMATION_SECONDS = REGISTRY.histogram(
+    "qubes_usbproxy_confirmation_seconds",
+    "Time waiting for the user to confirm an attach",
+    (1, 2.5, 5, 10, 30, 60, 120),
+)
+
+
+def cache_lookup(cache: str, hit: bool):
+    """Count a lookup in *cache*."""
+    CACHE_REQUESTS.inc(cache, "hit" if hit else "miss")
@@ -0,0 +1,162 @@
+# coding=utf-8
+#
+# The Qubes OS Project, https://www.qubes-os.org
+#
+# Copyright (C) 2026  The Qubes OS Project contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+"""
+Opt-in timing of extension event handlers.
+
+Enabled by `QUBES_USBPROXY_PROFILE` environment variable of qubesd, set to
+a threshold in milliseconds: handlers running longer are logged, together
+with the event and the qube. With `QUBES_USBPROXY_PROFILE_DIR` set too,
+synchronous handlers are also run under cProfile, and cumulative stats of
+a handler are dumped to `<dir>/<handler>.prof` after each of its slow calls.
+
+For generator handlers (device listing) only the time spent producing items
+is counted. For coroutine handlers it is the whole duration, including time
+spent waiting for other tasks.
+"""
+
+import cProfile
+import functools
+import inspect
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+THRESHOLD_MS: Optional[float] = None
+try:
+    THRESHOLD_MS = float(os.environ["QUBES_USBPROXY_PROFILE"])
+except (KeyError, ValueError):
+    pass
+PROFILE_DIR = os.environ.get("QUBES_USBPROXY_PROFILE_DIR")
+
+log = logging.getLogger("qubesusbproxy.profiling")
+
+_profilers: Dict[str, cProfile.Profile] = {}
+#: only one profiler can be active at a time, nested handler calls (like
+#: on_device_list_usb called from on_qdb_change) are profiled as part of
+#: the outer one
+_profiling = False
+
+
+def profile_handlers(cls):
+    """
+    Class decorator wrapping every event handler of the extension *cls*
+    with timing, if enabled (see module description).
+    """
+    if THRESHOLD_MS is None:
+        return cls
+    for name, attr in list(vars(cls).items()):
+        if callable(attr) and hasattr(attr, "ha_events"):
+            setattr(cls, name, _wrap_handler(attr))
+    return cls
+
+
+def _report(func, args, elapsed: float, profiler=None):
+    elapsed_ms = elapsed * 1000
+    if THRESHOLD_MS is None or elapsed_ms < THRESHOLD_MS:
+        return
+    # handlers are called as (self, subject, event, ...)
+    subject = args[1] if len(args) > 1 else None
+    event = args[2] if len(args) > 2 else None
+    log.warning(
+        "Slow USB handler %s: %.1fms (event %s, qube %s)",
+        func.__name__,
+        elapsed_ms,
+        event,
+        getattr(subject, "name", subject),
+    )
+    if profiler is not None and PROFILE_DIR:
+        try:
+            profiler.dump_stats(
+                os.path.join(PROFILE_DIR, func.__name__ + ".prof")
+            )
+        except OSError as e:
+            log.warning("Failed to dump profile of %s: %s", func.__name__, e)
+
+
+def _start_profiler(func):
+    global _profiling  # pylint: disable=global-statement
+    if not PROFILE_DIR or _profiling:
+        return None
+    profiler = _profilers.setdefault(func.__name__, cProfile.Profile())
+    try:
+        profiler.enable()
+    except ValueError:
+        # some other profiler is active
+        return None
+    _profiling = True
+    return profiler
+
+
+def _stop_profiler(profiler):
+    global _profiling  # pylint: disable=global-statement
+    if profiler is not None:
+        profiler.disable()
+        _profiling = False
+
+
+def _wrap_handler(func):
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                _report(func, args, time.perf_counter() - start)
+
+    elif inspect.isgeneratorfunction(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            elapsed = 0.0
+            profiler = None
+            gen = func(*args, **kwargs)
+            try:
+                while True:
+                    start = time.perf_counter()
+                    profiler = _start_profiler(func)
+                    try:
+                        item = next(gen)
+                    except StopIteration:
+                        return
+                    finally:
+                        _stop_profiler(profiler)
+                        elapsed += time.perf_counter() - start
+                    yield item
+            finally:
+                gen.close()
+                _report(func, args, elapsed, profiler)
+
+    else:
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            profiler = _start_profiler(func)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _stop_profiler(profiler)
+                _report(func, args, time.perf_counter() - start, profiler)
+
+    return wrapper
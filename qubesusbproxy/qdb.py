@@ -0,0 +1,234 @@
+# coding=utf-8
+#
+# The Qubes OS Project, https://www.qubes-os.org
+#
+# Copyright (C) 2026  The Qubes OS Project contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+"""
+QubesDB access of the USB proxy extension, kept off the qubesd event loop.
+
+After each device list change, `Snapshots.refresh` reads the whole
+`/qubes-usb-devices/` subtree of the backend in a thread of that backend
+(over a separate QubesDB connection, the one of the qube is used also for
+watches by qubesd), waiting at most `DEADLINE` seconds for it. A read that
+hangs (the backend is stuck) cannot be cancelled, so it holds only the thread
+of its backend, and further refreshes wait for it instead of starting more
+reads. Parsing of the snapshot data can use the shared `Snapshots.executor`
+pool, which never waits for QubesDB. Synchronous `read` and
+`list` (used by event handlers, which are synchronous in the legacy core too)
+are then served from that snapshot. If the backend doesn't answer in time,
+the previous snapshot stays in use. Without a snapshot (for example before
+the first change of a freshly started backend), they read QubesDB directly.
+"""
+
+import asyncio
+import concurrent.futures
+import dataclasses
+from typing import Any, Dict, List, Optional, Tuple
+
+from qubesusbproxy import metrics
+
+try:
+    import qubesdb
+except ImportError:
+    qubesdb = None
+
+#: the QubesDB subtree with USB devices of a backend
+PREFIX = "/qubes-usb-devices/"
+#: how long (in seconds) to wait for a backend's QubesDB, before serving
+#: the previous snapshot of its devices
+DEADLINE = 2
+#: threads parsing device data of backends (see `Snapshots.executor`)
+WORKERS = 4
+
+
+@dataclasses.dataclass
+class Snapshot:
+    """QubesDB data of USB devices of one backend."""
+
+    vm: Any
+    data: Optional[Dict[str, bytes]] = None
+    #: QubesDB connection used from the reader thread
+    connection: Any = None
+    #: thread reading QubesDB of this backend only
+    reader: Optional[concurrent.futures.ThreadPoolExecutor] = None
+    #: read in progress (may outlive the deadline, if the backend hangs)
+    pending: Optional[asyncio.Future] = None
+    lock: asyncio.Lock = dataclasses.field(default_factory=asyncio.Lock)
+    unresponsive: bool = False
+
+
+class Snapshots:
+    """Snapshots of QubesDB of backends, refreshed in threads."""
+
+    def __init__(self, deadline: float = DEADLINE, workers: int = WORKERS):
+        self.deadline = deadline
+        #: pool for work on snapshot data, not for QubesDB reads
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="usbproxy-qdb"
+        )
+        self.snapshots: Dict[str, Snapshot] = {}
+
+    def _current(self, vm) -> Optional[Dict[str, bytes]]:
+        snapshot = self.snapshots.get(vm.name)
+        if snapshot is None or snapshot.vm is not vm:
+            return None
+        return snapshot.data
+
+    def data(self, vm) -> Optional[Dict[str, bytes]]:
+        """
+        Current snapshot of *vm*, if any. It is replaced, not modified, by
+        refreshes, so it can be used from other threads.
+        """
+        return self._current(vm)
+
+    def read(self, vm, key: str) -> Optional[bytes]:
+        """Read *key* of *vm* QubesDB, from the snapshot if there is one."""
+        data = self._current(vm)
+        if data is None or not key.startswith(PREFIX):
+            metrics.cache_lookup("qubesdb", False)
+            metrics.QDB_READS.inc()
+            return vm.untrusted_qdb.read(key)
+        metrics.cache_lookup("qubesdb", True)
+        return data.get(key)
+
+    def list(self, vm, prefix: str) -> List[str]:
+        """List keys of *vm* QubesDB under *prefix*, like `read`."""
+        data = self._current(vm)
+        if data is None or not prefix.startswith(PREFIX):
+            metrics.cache_lookup("qubesdb", False)
+            metrics.QDB_READS.inc()
+            return vm.untrusted_qdb.list(prefix)
+        metrics.cache_lookup("qubesdb", True)
+        return [key for key in data if key.startswith(prefix)]
+
+    @staticmethod
+    def _read_all(snapshot: Snapshot) -> Tuple[Dict[str, bytes], int]:
+        # runs in the reader thread; returns the data and the number of reads
+        if snapshot.connection is None:
+            if qubesdb is not None and isinstance(
+                snapshot.vm.untrusted_qdb, qubesdb.QubesDB
+            ):
+                snapshot.connection = qubesdb.QubesDB(snapshot.vm.name)
+            else:
+                snapshot.connection = snapshot.vm.untrusted_qdb
+        try:
+            if hasattr(snapshot.connection, "multiread"):
+                return snapshot.connection.multiread(PREFIX), 1
+            keys = snapshot.connection.list(PREFIX)
+            data = {key: snapshot.connection.read(key) for key in keys}
+            return data, len(keys) + 1
+        except Exception:
+            # reconnect next time
+            Snapshots._close(snapshot)
+            raise
+
+    @staticmethod
+    def _close(snapshot: Snapshot):
+        connection, snapshot.connection = snapshot.connection, None
+        if (
+            connection is not None
+            and connection is not snapshot.vm.untrusted_qdb
+        ):
+            connection.close()
+
+    async def refresh(self, vm) -> bool:
+        """
+        Read current USB devices data of *vm* into its snapshot. Return False
+        if that failed or didn't finish in time, and the previous data (if
+        any) is still used.
+        """
+        snapshot = self.snapshots.get(vm.name)
+        if snapshot is None or snapshot.vm is not vm:
+            self.forget(vm.name)
+            snapshot = self.snapshots[vm.name] = Snapshot(vm)
+        # refreshes requested later must see later changes, wait for the
+        # previous read before starting the next one
+        async with snapshot.lock:
+            if self.snapshots.get(vm.name) is not snapshot:
+                # forgotten meanwhile (like the qube shut down)
+                return False
+            if snapshot.reader is None:
+                snapshot.reader = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="usbproxy-qdb"
+                )
+            if snapshot.pending is None or snapshot.pending.done():
+                snapshot.pending = asyncio.get_running_loop().run_in_executor(
+                    snapshot.reader, self._read_all, snapshot
+                )
+                # count the reads even if they finish after the deadline
+                snapshot.pending.add_done_callback(_count_reads)
+            try:
+                data, _ = await asyncio.wait_for(
+                    asyncio.shield(snapshot.pending), self.deadline
+                )
+            except asyncio.TimeoutError:
+                metrics.QDB_TIMEOUTS.inc(vm.name)
+                if not snapshot.unresponsive:
+                    snapshot.unresponsive = True
+                    vm.log.warning(
+                        f"QubesDB not responding in {self.deadline}s, "
+                        "using previous USB devices data"
+                    )
+                return False
+            except Exception as e:  # pylint: disable=broad-except
+                vm.log.warning(f"Failed to read USB devices from QubesDB: {e}")
+                return False
+            if snapshot.unresponsive:
+                snapshot.unresponsive = False
+                vm.log.info("QubesDB responding again")
+            snapshot.data = data
+            return True
+
+    def _drop(self, snapshot: Snapshot):
+        if snapshot.reader is not None:
+            # the thread ends after the read in progress, if any
+            snapshot.reader.shutdown(wait=False)
+        if snapshot.pending is not None and not snapshot.pending.done():
+            # don't close the connection under a read in progress
+            snapshot.pending.add_done_callback(lambda _: self._close(snapshot))
+        else:
+            self._close(snapshot)
+
+    def forget(self, name: str):
+        """Drop the snapshot of qube *name* (like when it shuts down)."""
+        snapshot = self.snapshots.pop(name, None)
+        if snapshot is not None:
+            self._drop(snapshot)
+
+    def clear(self):
+        for snapshot in self.snapshots.values():
+            self._drop(snapshot)
+        self.snapshots.clear()
+
+
+def _count_reads(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is None:
+        metrics.QDB_READS.inc(amount=future.result()[1])
+
+
+SNAPSHOTS = Snapshots()
+
+
+def read(vm, key: str) -> Optional[bytes]:
+    """Read *key* of *vm* QubesDB (see `Snapshots.read`)."""
+    return SNAPSHOTS.read(vm, key)
+
+
+def list_keys(vm, prefix: str) -> List[str]:
+    """List keys of *vm* QubesDB under *prefix* (see `Snapshots.list`)."""
+    return SNAPSHOTS.list(vm, prefix)
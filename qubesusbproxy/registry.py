@@ -0,0 +1,177 @@
+# coding=utf-8
+#
+# The Qubes OS Project, https://www.qubes-os.org
+#
+# Copyright (C) 2026  The Qubes OS Project contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+"""
+Registry of USB devices exposed by backends, for device queries of the dom0
+extension.
+
+The extension updates it after each device list change of a backend
+(`DeviceRegistry.update`), after its own attaches and detaches
+(`DeviceRegistry.attach`), and when a qube shuts down, is removed or renamed
+(`DeviceRegistry.forget`). Devices are indexed by (backend name, port_id)
+and by the frontend they are attached to, so listing devices of a backend or
+attached to a qube, and getting a device, take time proportional to the
+result, not to the number of qubes or devices.
+
+Device objects are kept as long as the device stays in the same port with
+the same QubesDB data (its signature), so their lazily loaded properties are
+read from QubesDB and sanitized only once.
+
+Device list changes of each backend are numbered (`DeviceRegistry.record`).
+Numbers of a backend increase with its changes only; a backend forgotten and
+seen again continues above any number given out before, so numbers of its
+previous run are never taken for current ones.
+"""
+
+import dataclasses
+from typing import Any, Dict, Hashable, List, Optional, Set, Tuple
+
+#: (backend name, port_id)
+Key = Tuple[str, str]
+
+
+@dataclasses.dataclass
+class Entry:
+    """A device exposed by a backend."""
+
+    device: Any
+    #: QubesDB data the device was built from
+    signature: Hashable
+    #: qube the device is attached to
+    frontend: Any = None
+
+
+class DeviceRegistry:
+    """USB devices of backends, indexed for device queries."""
+
+    def __init__(self):
+        #: highest generation given out (to any backend)
+        self.generation = 0
+        #: backend name -> generation of its last device list change
+        self.generations: Dict[str, int] = {}
+        #: backend name -> port_id -> entry
+        self.backends: Dict[str, Dict[str, Entry]] = {}
+        #: frontend name -> (backend name, port_id) of devices attached to it
+        self.frontends: Dict[str, Set[Key]] = {}
+
+    def tracks(self, backend: str) -> bool:
+        """Whether *backend* has any devices in the registry."""
+        return backend in self.backends
+
+    def devices(self, backend: str) -> List[Any]:
+        """Devices exposed by *backend*."""
+        return [
+            entry.device for entry in self.backends.get(backend, {}).values()
+        ]
+
+    def get(self, backend: str, port_id: str) -> Optional[Any]:
+        """Device of *backend* in *port_id*, if any."""
+        entry = self.backends.get(backend, {}).get(port_id)
+        return None if entry is None else entry.device
+
+    def attached_to(self, frontend: str) -> List[Any]:
+        """Devices attached to qube named *frontend*."""
+        return [
+            self.backends[backend][port_id].device
+            for backend, port_id in self.frontends.get(frontend, ())
+        ]
+
+    def update(
+        self, backend: str, devices: Dict[str, Tuple[Any, Hashable]]
+    ) -> Tuple[Dict[str, Any], Set[str]]:
+        """
+        Set devices of *backend* to *devices* (port_id -> (device,
+        signature)). Known devices with the same signature are kept, and
+        returned (port_id -> device) instead of the new ones, together with
+        port_ids where a known device was replaced by one with another
+        signature.
+        """
+        entries = self.backends.get(backend, {})
+        for port_id in set(entries) - set(devices):
+            self._remove(backend, port_id)
+        result = {}
+        replaced = set()
+        for port_id, (device, signature) in devices.items():
+            entry = entries.get(port_id)
+            if entry is not None and entry.signature == signature:
+                result[port_id] = entry.device
+                continue
+            if entry is not None:
+                self._remove(backend, port_id)
+                replaced.add(port_id)
+            entry = Entry(device, signature)
+            self.backends.setdefault(backend, {})[port_id] = entry
+            result[port_id] = device
+        return result, replaced
+
+    def record(self, backend: str) -> int:
+        """
+        Record a change of devices of *backend*, return its generation (of
+        that backend).
+        """
+        # a backend seen again continues above any number given out before
+        generation = self.generations.get(backend, self.generation) + 1
+        self.generations[backend] = generation
+        self.generation = max(self.generation, generation)
+        return generation
+
+    def attach(self, backend: str, port_id: str, frontend: Any):
+        """Record device of *backend* in *port_id* attached to *frontend*."""
+        entry = self.backends.get(backend, {}).get(port_id)
+        if entry is None or entry.frontend == frontend:
+            return
+        key = (backend, port_id)
+        if entry.frontend is not None:
+            _discard(self.frontends, entry.frontend.name, key)
+        entry.frontend = frontend
+        if frontend is not None:
+            self.frontends.setdefault(frontend.name, set()).add(key)
+
+    def _remove(self, backend: str, port_id: str):
+        entries = self.backends[backend]
+        entry = entries.pop(port_id)
+        if not entries:
+            del self.backends[backend]
+        key = (backend, port_id)
+        if entry.frontend is not None:
+            _discard(self.frontends, entry.frontend.name, key)
+
+    def forget(self, name: str):
+        """Drop devices of backend *name*, and attachments to qube *name*."""
+        for port_id in list(self.backends.get(name, ())):
+            self._remove(name, port_id)
+        for backend, port_id in list(self.frontends.get(name, ())):
+            self.backends[backend][port_id].frontend = None
+        self.frontends.pop(name, None)
+        self.generations.pop(name, None)
+
+    def clear(self):
+        self.generations.clear()
+        self.backends.clear()
+        self.frontends.clear()
+
+
+def _discard(index: Dict[Any, Set[Key]], value: Any, key: Key):
+    keys = index.get(value)
+    if keys is None:
+        return
+    keys.discard(key)
+    if not keys:
+        del index[value]
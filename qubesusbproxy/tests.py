@@ -21,6 +21,11 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
+import collections
+import json
+import os
+import tempfile
+import threading
 import time
 import uuid
 import unittest
@@ -34,6 +39,10 @@ core3 = False
 LEGACY = False
 try:
     import qubesusbproxy.core3ext
+    import qubesusbproxy.metrics
+    import qubesusbproxy.profiling
+    import qubesusbproxy.qdb
+    import qubesusbproxy.registry
     import asyncio
 
     try:
@@ -631,6 +640,7 @@ class TestVM(qubes.tests.TestEmitter):
             "4.2" if name == "qubes-agent-version" else None
         )
         self.is_running = lambda: running
+        self.get_power_state = lambda: "Running" if running else "Halted"
         self.log = mock.Mock()
         self.app = TestApp()
         self.devices = {"testclass": TestDeviceCollection(self, "testclass")}
@@ -1034,6 +1044,963 @@ class TC_30_USBProxy_core3(qubes.tests.QubesTestCase):
         )
         self.assertIsNone(self.ext.devices_cache["sys-usb"]["1-1"])
 
+    def test_040_warm_up_on_start(self):
+        back, front = self.added_assign_setup()
+
+        exp_dev = qubesusbproxy.core3ext.USBDevice(Port(back, "1-2", "usb"))
+        assmnt = DeviceAssignment(exp_dev, mode="auto-attach")
+        front.devices["usb"]._assigned.append(assmnt)
+
+        front.virt_mode = "pvh"
+        front.features.check_with_template.side_effect = (
+            lambda name, default: name == "supported-feature.usb-warmup"
+            or default
+        )
+        front.run_service_for_stdio = AsyncMock()
+
+        loop = asyncio.get_event_loop()
+        with mock.patch.object(self.ext, "attach_and_notify"):
+            loop.run_until_complete(self.ext.on_domain_start(front, None))
+            loop.run_until_complete(asyncio.sleep(0))
+        front.run_service_for_stdio.assert_called_once_with(
+            "qubes.USBWarmup", user="root"
+        )
+
+    def test_041_no_warm_up_without_assignments(self):
+        _back, front = self.added_assign_setup()
+
+        front.virt_mode = "pvh"
+        front.features.check_with_template.side_effect = (
+            lambda name, default: name == "supported-feature.usb-warmup"
+            or default
+        )
+        front.run_service_for_stdio = AsyncMock()
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.ext.on_domain_start(front, None))
+        loop.run_until_complete(asyncio.sleep(0))
+        front.run_service_for_stdio.assert_not_called()
+
+    def test_050_restore_after_suspend(self):
+        back, front = self.added_assign_setup(attachment="front-vm")
+        self.ext.devices_cache = collections.defaultdict(
+            dict, {"sys-usb": {"1-1": front, "1-2": None}}
+        )
+        exp_dev = qubesusbproxy.core3ext.USBDevice(Port(back, "1-1", "usb"))
+
+        # usb-detach-all in the backend before suspend
+        qdb = back.untrusted_qdb._data
+        del qdb["/qubes-usb-devices/1-1/connected-to"]
+        qdb["/qubes-usb-devices/1-1/x-suspended"] = b"1"
+        with mock.patch("asyncio.ensure_future"):
+            self.ext.on_qdb_change(back, None, None)
+        self.assertEqual(
+            self.ext.suspended_attachments,
+            {("sys-usb", "1-1"): (back, front, exp_dev.device_id)},
+        )
+
+        loop = asyncio.get_event_loop()
+        front.fire_event_async = AsyncMock()
+        with mock.patch.object(
+            self.ext, "on_device_attach_usb", new_callable=AsyncMock
+        ) as attach, mock.patch.object(
+            self.ext, "_auto_attach_devices", new_callable=AsyncMock
+        ):
+            loop.run_until_complete(self.ext.on_domain_resumed(back, None))
+        attach.assert_called_once()
+        self.assertEqual(attach.call_args[0][0], front)
+        self.assertEqual(attach.call_args[0][2].port_id, "1-1")
+        self.assertEqual(self.ext.suspended_attachments, {})
+
+    def test_051_no_restore_after_detach(self):
+        back, front = self.added_assign_setup(attachment="front-vm")
+        self.ext.devices_cache = collections.defaultdict(
+            dict, {"sys-usb": {"1-1": front, "1-2": None}}
+        )
+
+        # detached in the backend, but not because of suspend
+        del back.untrusted_qdb._data["/qubes-usb-devices/1-1/connected-to"]
+        with mock.patch("asyncio.ensure_future"):
+            self.ext.on_qdb_change(back, None, None)
+        self.assertEqual(self.ext.suspended_attachments, {})
+
+    def test_052_release_failure(self):
+        back, front = self.added_assign_setup(attachment="front-vm")
+        front.qid = 2
+        self.ext.devices_cache = collections.defaultdict(
+            dict, {"sys-usb": {"1-1": front, "1-2": None}}
+        )
+        with mock.patch("asyncio.ensure_future"):
+            self.ext.on_qdb_change(back, None, None)
+        qdb = back.untrusted_qdb._data
+
+        async def usb_detach(service, user, input):
+            # pylint: disable=redefined-builtin,unused-argument
+            self.assertEqual((service, input), ("qubes.USBDetach", b"1-1\n"))
+            # the release keeps running after qubes.USBDetach returns
+            del qdb["/qubes-usb-devices/1-1/connected-to"]
+            qdb["/qubes-usb-devices/1-1/x-release"] = b"pending"
+            return b"", b""
+
+        back.run_service_for_stdio = usb_detach
+        asyncio.get_event_loop().run_until_complete(
+            self.ext.on_device_detach_usb(
+                front, "device-pre-detach:usb", Port(back, "1-1", "usb")
+            )
+        )
+        self.assertEqual(self.ext.pending_releases, {"sys-usb": {"1-1"}})
+
+        self.ext.on_qdb_change(back, None, None)
+        self.assertEqual(self.ext.pending_releases, {"sys-usb": {"1-1"}})
+        back.log.warning.assert_not_called()
+
+        qdb["/qubes-usb-devices/1-1/x-release"] = b"failed"
+        self.ext.on_qdb_change(back, None, None)
+        self.assertEqual(self.ext.pending_releases, {})
+        back.log.warning.assert_called_once()
+
+    @staticmethod
+    def reenumerate(vm, old_port, new_port):
+        qdb = vm.untrusted_qdb._data
+        for key in list(qdb):
+            if key.startswith(f"/qubes-usb-devices/{old_port}/"):
+                value = qdb.pop(key)
+                if not key.endswith("/connected-to"):
+                    qdb[key.replace(old_port, new_port)] = value
+
+    def test_060_reattach_reappeared(self):
+        back, front = self.added_assign_setup(attachment="front-vm")
+        back.untrusted_qdb._data["/qubes-usb-devices/1-1/desc"] = (
+            b"1a0a:badd USB-IF Test\x20Device 0123"
+        )
+        self.ext.devices_cache = collections.defaultdict(
+            dict, {"sys-usb": {"1-1": front, "1-2": None}}
+        )
+        with mock.patch("asyncio.ensure_future"):
+            self.ext.on_qdb_change(back, None, None)
+
+        self.reenumerate(back, "1-1", "1-3")
+        with mock.patch.object(
+            self.ext, "_reattach", new_callable=Mock
+        ) as reattach, mock.patch("asyncio.ensure_future"):
+            self.ext.on_qdb_change(back, None, None)
+        reattach.assert_called_once()
+        self.assertEqual(reattach.call_args[0][0], front)
+        self.assertEqual(reattach.call_args[0][1].port_id, "1-3")
+        self.assertEqual(self.ext.reattaching, {("sys-usb", "1-3")})
+        self.assertEqual(self.ext.recent_attachments, {})
+
+    def test_061_no_reattach_assigned_elsewhere(self):
+        back, front = self.added_assign_setup(attachment="front-vm")
+        other = TestVM({}, name="other-vm")
+        other.app = back.app
+        back.app.domains["other-vm"] = other
+        other.devices["usb"] = TestDeviceCollection(
+            backend_vm=other, devclass="usb"
+        )
+        exp_dev = qubesusbproxy.core3ext.USBDevice(Port(back, "1-1", "usb"))
+        other.devices["usb"]._assigned.append(
+            DeviceAssignment(
+                VirtualDevice(Port(back, "*", "usb"), exp_dev.device_id),
+                mode="auto-attach",
+            )
+        )
+        self.ext.devices_cache = collections.defaultdict(
+            dict, {"sys-usb": {"1-1": front, "1-2": None}}
+        )
+        with mock.patch("asyncio.ensure_future"):
+            self.ext.on_qdb_change(back, None, None)
+
+        self.reenumerate(back, "1-1", "1-3")
+        resolver_path = "qubes.ext.utils.resolve_conflicts_and_attach"
+        with mock.patch.object(
+            self.ext, "_reattach", new_callable=Mock
+        ) as reattach, mock.patch(resolver_path, new_callable=Mock), mock.patch(
+            "asyncio.ensure_future"
+        ):
+            self.ext.on_qdb_change(back, None, None)
+        reattach.assert_not_called()
+        self.assertEqual(self.ext.reattaching, set())
+
+    def test_062_no_reattach_lookalike(self):
+        back, front = self.added_assign_setup(attachment="front-vm")
+        self.ext.devices_cache = collections.defaultdict(
+            dict, {"sys-usb": {"1-1": front, "1-2": None}}
+        )
+        with mock.patch("asyncio.ensure_future"):
+            self.ext.on_qdb_change(back, None, None)
+
+        # without a serial number, only in the same port
+        self.reenumerate(back, "1-1", "1-3")
+        resolver_path = "qubes.ext.utils.resolve_conflicts_and_attach"
+        with mock.patch.object(
+            self.ext, "_reattach", new_callable=Mock
+        ) as reattach, mock.patch(resolver_path, new_callable=Mock), mock.patch(
+            "asyncio.ensure_future"
+        ):
+            self.ext.on_qdb_change(back, None, None)
+        reattach.assert_not_called()
+        self.assertEqual(self.ext.reattaching, set())
+
+    def test_063_no_reattach_ask_to_attach(self):
+        back, front = self.added_assign_setup(attachment="front-vm")
+        exp_dev = qubesusbproxy.core3ext.USBDevice(Port(back, "1-1", "usb"))
+        front.devices["usb"]._assigned.append(
+            DeviceAssignment(
+                VirtualDevice(exp_dev.port, exp_dev.device_id),
+                mode="ask-to-attach",
+            )
+        )
+        self.ext.devices_cache = collections.defaultdict(
+            dict, {"sys-usb": {"1-1": front, "1-2": None}}
+        )
+        with mock.patch("asyncio.ensure_future"):
+            self.ext.on_qdb_change(back, None, None)
+
+        # the same port, but the user wants to confirm each attach
+        self.reenumerate(back, "1-1", "1-3")
+        with mock.patch("asyncio.ensure_future"):
+            self.ext.on_qdb_change(back, None, None)
+        self.reenumerate(back, "1-3", "1-1")
+        resolver_path = "qubes.ext.utils.resolve_conflicts_and_attach"
+        with mock.patch.object(
+            self.ext, "_reattach", new_callable=Mock
+        ) as reattach, mock.patch(resolver_path, new_callable=Mock), mock.patch(
+            "asyncio.ensure_future"
+        ):
+            self.ext.on_qdb_change(back, None, None)
+        reattach.assert_not_called()
+
+    def test_070_parent_device(self):
+        back, _ = self.added_assign_setup()
+        self.add_hub_devices(back, "1-1", 2)
+        self.add_hub_devices(back, "1-1.2", 3)
+        dev = qubesusbproxy.core3ext.USBDevice(Port(back, "1-1.2.3", "usb"))
+        self.assertEqual(dev.parent_device.port_id, "1-1.2")
+        self.assertEqual(dev.parent_device.parent_device.port_id, "1-1")
+        self.assertIsNone(dev.parent_device.parent_device.parent_device)
+
+    def test_071_parent_device_not_exposed(self):
+        back, _ = self.added_assign_setup()
+        # the hub at 1-2.4 is not exposed by the backend
+        self.add_hub_devices(back, "1-2.4", 1)
+        dev = qubesusbproxy.core3ext.USBDevice(Port(back, "1-2.4.1", "usb"))
+        self.assertIsNone(dev.parent_device)
+
+    @staticmethod
+    def add_hub_devices(vm, hub_port, count, attachment=None):
+        qdb = vm.untrusted_qdb._data
+        for i in range(1, count + 1):
+            ident = f"{hub_port}_{i}".replace(".", "_")
+            qdb[f"/qubes-usb-devices/{ident}/desc"] = (
+                f"1a0a:{i:04x} USB-IF Hub\\x20Device\\x20{i}".encode()
+            )
+            qdb[f"/qubes-usb-devices/{ident}/interfaces"] = b":030101:"
+            qdb[f"/qubes-usb-devices/{ident}/usb-ver"] = b"2"
+            if attachment:
+                qdb[f"/qubes-usb-devices/{ident}/connected-to"] = (
+                    attachment.encode()
+                )
+
+    @mock.patch("qubesusbproxy.core3ext.modify_qrexec_policy")
+    def test_080_bulk_attach(self, _modify_policy):
+        back, front = self.added_assign_setup()
+        self.add_hub_devices(back, "1-3", 2)
+        front.qid = 2
+        front.virt_mode = "pvh"
+        front.features.check_with_template.side_effect = (
+            lambda name, default: name == "supported-feature.usb-bulk-attach"
+            or default
+        )
+
+        loop = asyncio.get_event_loop()
+        proc = Mock()
+        proc.stdin.drain = AsyncMock()
+        proc.stdout = asyncio.StreamReader()
+        proc.stdout.feed_data(b"failed 1-3.2 1\nattached 1-3.1\n")
+        proc.stdout.feed_eof()
+        proc.stderr = asyncio.StreamReader()
+        proc.stderr.feed_eof()
+        proc.wait = AsyncMock(return_value=1)
+        front.run_service = AsyncMock(return_value=proc)
+
+        devices = [
+            qubesusbproxy.core3ext.USBDevice(Port(back, port_id, "usb"))
+            for port_id in ("1-3.1", "1-3.2")
+        ]
+        results = loop.run_until_complete(
+            asyncio.gather(
+                *(
+                    self.ext.on_device_attach_usb(
+                        front, "device-pre-attach:usb", device, {}
+                    )
+                    for device in devices
+                ),
+                return_exceptions=True,
+            )
+        )
+        front.run_service.assert_called_once()
+        proc.stdin.write.assert_called_once_with(
+            b"sys-usb 1-3.1\nsys-usb 1-3.2\n"
+        )
+        self.assertIsNone(results[0])
+        self.assertIsInstance(
+            results[1], qubesusbproxy.core3ext.QubesUSBException
+        )
+
+    @mock.patch("qubesusbproxy.core3ext.modify_qrexec_policy")
+    def test_081_bulk_attach_two_backends(self, _modify_policy):
+        back, front = self.added_assign_setup()
+        other = TestVM(qdb={}, name="sys-usb2")
+        other.app = back.app
+        back.app.domains["sys-usb2"] = other
+        other.devices["usb"] = TestDeviceCollection(
+            backend_vm=other, devclass="usb"
+        )
+        self.add_hub_devices(back, "1-3", 2)
+        self.add_hub_devices(other, "1-3", 2)
+        front.qid = 2
+        front.virt_mode = "pvh"
+        front.features.check_with_template.side_effect = (
+            lambda name, default: name == "supported-feature.usb-bulk-attach"
+            or default
+        )
+
+        procs = []
+
+        async def run_service(*_args, **_kwargs):
+            proc = Mock()
+            proc.stdin.drain = AsyncMock()
+            proc.stdout = asyncio.StreamReader()
+            proc.stdout.feed_data(b"attached 1-3.1\nattached 1-3.2\n")
+            proc.stdout.feed_eof()
+            proc.stderr = asyncio.StreamReader()
+            proc.stderr.feed_eof()
+            proc.wait = AsyncMock(return_value=0)
+            procs.append(proc)
+            return proc
+
+        front.run_service = run_service
+
+        devices = [
+            qubesusbproxy.core3ext.USBDevice(Port(backend, port_id, "usb"))
+            for backend in (back, other)
+            for port_id in ("1-3.1", "1-3.2")
+        ]
+        results = asyncio.get_event_loop().run_until_complete(
+            asyncio.gather(
+                *(
+                    self.ext.on_device_attach_usb(
+                        front, "device-pre-attach:usb", device, {}
+                    )
+                    for device in devices
+                ),
+                return_exceptions=True,
+            )
+        )
+        # the same busid on two backends, one call for each backend
+        self.assertEqual(results, [None] * 4)
+        self.assertEqual(
+            sorted(proc.stdin.write.call_args[0][0] for proc in procs),
+            [
+                b"sys-usb 1-3.1\nsys-usb 1-3.2\n",
+                b"sys-usb2 1-3.1\nsys-usb2 1-3.2\n",
+            ],
+        )
+        self.assertEqual(
+            self.ext.devices_cache["sys-usb2"],
+            {"1-3.1": front, "1-3.2": front},
+        )
+
+    @mock.patch("qubesusbproxy.core3ext.modify_qrexec_policy")
+    def test_082_attach_batch_cancelled(self, _modify_policy):
+        back, front = self.added_assign_setup()
+        self.add_hub_devices(back, "1-3", 2)
+        front.qid = 2
+        front.run_service = AsyncMock()
+        front.run_service_for_stdio = AsyncMock()
+        devices = [
+            qubesusbproxy.core3ext.USBDevice(Port(back, port_id, "usb"))
+            for port_id in ("1-3.1", "1-3.2")
+        ]
+
+        async def attach_and_cancel():
+            tasks = [
+                asyncio.ensure_future(
+                    self.ext.on_device_attach_usb(
+                        front, "device-pre-attach:usb", device, {}
+                    )
+                )
+                for device in devices
+            ]
+            # both joined the batch, the first one is about to start it
+            await asyncio.sleep(0)
+            tasks[0].cancel()
+            return await asyncio.wait_for(
+                asyncio.gather(*tasks, return_exceptions=True), 5
+            )
+
+        results = asyncio.get_event_loop().run_until_complete(
+            attach_and_cancel()
+        )
+        # the other attach of the batch doesn't wait forever
+        for result in results:
+            self.assertIsInstance(result, asyncio.CancelledError)
+        self.assertEqual(self.ext.attach_batches, {})
+        front.run_service.assert_not_called()
+        front.run_service_for_stdio.assert_not_called()
+
+    @mock.patch("qubesusbproxy.core3ext.modify_qrexec_policy")
+    def test_090_attach_trace(self, _modify_policy):
+        back, front = self.added_assign_setup()
+        front.qid = 2
+        front.virt_mode = "pvh"
+        front.features.check_with_template.side_effect = (
+            lambda name, default: name == "supported-feature.usb-attach-trace"
+            or default
+        )
+
+        async def run_service_for_stdio(service, user, input):
+            # pylint: disable=redefined-builtin,unused-argument
+            domain, port_id, trace_id = input.decode().split()
+            self.assertEqual((domain, port_id), ("sys-usb", "1-2"))
+            return (
+                f"trace 1-2 {trace_id} import-connect:10:2000,"
+                "import-attach:2010:30 export-bind:5:500,bad;span:1:1\n"
+            ).encode(), b""
+
+        front.run_service_for_stdio = run_service_for_stdio
+        device = qubesusbproxy.core3ext.USBDevice(Port(back, "1-2", "usb"))
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(
+            self.ext.on_device_attach_usb(
+                front, "device-pre-attach:usb", device, {}
+            )
+        )
+
+        (trace,) = self.ext.attach_traces
+        self.assertEqual(
+            (trace.frontend, trace.backend, trace.port_id),
+            ("front-vm", "sys-usb", "1-2"),
+        )
+        self.assertIsNone(trace.error)
+        self.assertIn(("frontend", "import-connect", 10, 2000), trace.spans)
+        self.assertIn(("frontend", "import-attach", 2010, 30), trace.spans)
+        self.assertIn(("backend", "export-bind", 5, 500), trace.spans)
+        self.assertEqual(
+            [name for side, name, _, _ in trace.spans if side == "dom0"],
+            ["policy", "qubes.USBAttach", "total"],
+        )
+        self.assertEqual(len(trace.spans), 6)
+
+    def test_100_metrics_render(self):
+        registry = qubesusbproxy.metrics.Registry(path=None)
+        counter = registry.counter("test_total", "Test counter", ("kind",))
+        histogram = registry.histogram("test_seconds", "Test histogram", (1, 5))
+        counter.inc("a")
+        counter.inc("a")
+        counter.inc('b"')
+        histogram.observe(0.5)
+        histogram.observe(3)
+        histogram.observe(10)
+        self.assertEqual(
+            registry.render(),
+            "# HELP test_total Test counter\n"
+            "# TYPE test_total counter\n"
+            'test_total{kind="a"} 2\n'
+            'test_total{kind="b\\""} 1\n'
+            "# HELP test_seconds Test histogram\n"
+            "# TYPE test_seconds histogram\n"
+            'test_seconds_bucket{le="1"} 1\n'
+            'test_seconds_bucket{le="5"} 2\n'
+            'test_seconds_bucket{le="+Inf"} 3\n'
+            "test_seconds_sum 13.5\n"
+            "test_seconds_count 3\n",
+        )
+
+    def test_101_metrics_attach_failure(self):
+        back, front = self.added_assign_setup(attachment="front-vm")
+        front.qid = 2
+        device = qubesusbproxy.core3ext.USBDevice(Port(back, "1-1", "usb"))
+        failures = qubesusbproxy.metrics.ATTACH_FAILURES
+        before = failures.value("DeviceAlreadyAttached")
+        loop = asyncio.get_event_loop()
+        with self.assertRaises(qubes.exc.DeviceAlreadyAttached):
+            loop.run_until_complete(
+                self.ext.on_device_attach_usb(
+                    front, "device-pre-attach:usb", device, {}
+                )
+            )
+        self.assertEqual(failures.value("DeviceAlreadyAttached"), before + 1)
+
+    def test_110_profile_handlers(self):
+        back, _ = self.added_assign_setup()
+
+        class Extension:
+            @qubes.ext.handler("device-list:usb")
+            def on_device_list_usb(self, vm, event):
+                # pylint: disable=unused-argument
+                yield from ("1-1", "1-2")
+
+            @qubes.ext.handler("domain-start")
+            async def on_domain_start(self, vm, event):
+                # pylint: disable=unused-argument
+                return vm.name
+
+        with mock.patch("qubesusbproxy.profiling.THRESHOLD_MS", 0):
+            qubesusbproxy.profiling.profile_handlers(Extension)
+            ext = Extension()
+            with self.assertLogs("qubesusbproxy.profiling") as logs:
+                self.assertEqual(
+                    list(ext.on_device_list_usb(back, "device-list:usb")),
+                    ["1-1", "1-2"],
+                )
+                self.assertEqual(
+                    asyncio.get_event_loop().run_until_complete(
+                        ext.on_domain_start(back, "domain-start")
+                    ),
+                    "sys-usb",
+                )
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn("on_device_list_usb", logs.output[0])
+        self.assertIn("device-list:usb", logs.output[0])
+        self.assertIn("sys-usb", logs.output[0])
+        self.assertEqual(
+            Extension.on_device_list_usb.ha_events, ("device-list:usb",)
+        )
+        self.assertTrue(asyncio.iscoroutinefunction(Extension.on_domain_start))
+
+    def test_120_coalesce_qdb_changes(self):
+        back, _ = self.added_assign_setup()
+        coalesced = qubesusbproxy.metrics.QDB_EVENTS_COALESCED
+        before = coalesced.value()
+
+        async def burst():
+            for key in ("desc", "interfaces", "usb-ver"):
+                self.ext.on_qdb_change(
+                    back, None, f"/qubes-usb-devices/1-2/{key}"
+                )
+            handle.assert_not_called()
+            await asyncio.sleep(0.05)
+
+        with mock.patch(
+            "qubesusbproxy.core3ext.QDB_COALESCE_WINDOW", 0.01
+        ), mock.patch.object(self.ext, "_handle_qdb_change") as handle:
+            asyncio.get_event_loop().run_until_complete(burst())
+        handle.assert_called_once_with(back, "/qubes-usb-devices/1-2/usb-ver")
+        self.assertEqual(coalesced.value(), before + 2)
+        self.assertEqual(self.ext.pending_qdb_changes, {})
+
+    def test_121_rescan_rate_limit(self):
+        back, _ = self.added_assign_setup()
+        throttled = qubesusbproxy.metrics.RESCANS_THROTTLED
+        before = throttled.value("sys-usb")
+
+        async def flood():
+            for _ in range(5):
+                self.ext.on_qdb_change(back, None, "/qubes-usb-devices")
+            await asyncio.sleep(0.05)
+            self.assertEqual(handle.call_count, 2)
+            await asyncio.sleep(0.15)
+
+        with mock.patch(
+            "qubesusbproxy.core3ext.QDB_COALESCE_WINDOW", 0
+        ), mock.patch("qubesusbproxy.core3ext.RESCAN_RATE", 10), mock.patch(
+            "qubesusbproxy.core3ext.RESCAN_BURST", 2
+        ), mock.patch.object(
+            self.ext, "_handle_qdb_change"
+        ) as handle:
+            asyncio.get_event_loop().run_until_complete(flood())
+        # the rest is merged into a single postponed rescan
+        self.assertEqual(handle.call_count, 3)
+        self.assertEqual(throttled.value("sys-usb"), before + 1)
+        back.log.warning.assert_called_once()
+        self.assertEqual(self.ext.pending_qdb_changes, {})
+
+    def test_122_token_bucket(self):
+        with mock.patch("time.monotonic", return_value=100.0) as monotonic:
+            bucket = qubesusbproxy.core3ext.TokenBucket(rate=2, burst=2)
+            self.assertEqual(bucket.take(), 0)
+            self.assertEqual(bucket.take(), 0)
+            self.assertAlmostEqual(bucket.take(), 0.5)
+            monotonic.return_value = 100.5
+            self.assertEqual(bucket.take(), 0)
+            monotonic.return_value = 110
+            self.assertEqual(bucket.take(), 0)
+            self.assertEqual(bucket.take(), 0)
+            self.assertAlmostEqual(bucket.take(), 0.5)
+
+    def test_123_qdb_snapshot(self):
+        back, _ = self.added_assign_setup()
+        snapshots = qubesusbproxy.qdb.Snapshots(deadline=0.1, workers=1)
+        self.addCleanup(snapshots.executor.shutdown)
+        self.addCleanup(snapshots.clear)
+        loop = asyncio.get_event_loop()
+        desc = "/qubes-usb-devices/1-2/desc"
+        expected = back.untrusted_qdb.read(desc)
+        self.assertTrue(loop.run_until_complete(snapshots.refresh(back)))
+
+        # served from the snapshot, until the next refresh
+        del back.untrusted_qdb._data[desc]
+        self.assertEqual(snapshots.read(back, desc), expected)
+        self.assertEqual(
+            sorted(snapshots.list(back, "/qubes-usb-devices/1-2/")),
+            [
+                desc,
+                "/qubes-usb-devices/1-2/interfaces",
+                "/qubes-usb-devices/1-2/usb-ver",
+            ],
+        )
+
+        # unresponsive backend: keep the previous data
+        unblock = threading.Event()
+        back.untrusted_qdb.list = lambda prefix: unblock.wait() and []
+        self.assertFalse(loop.run_until_complete(snapshots.refresh(back)))
+        back.log.warning.assert_called_once()
+        self.assertEqual(snapshots.read(back, desc), expected)
+        # ... without holding up reads of other backends
+        another = TestVM(qdb=get_qdb(), name="sys-usb2")
+        self.assertTrue(loop.run_until_complete(snapshots.refresh(another)))
+        self.assertEqual(snapshots.read(another, desc), expected)
+        unblock.set()
+
+        # other qube with the same name doesn't get the old data
+        other, _ = self.added_assign_setup()
+        self.assertIsNone(snapshots.read(other, "/qubes-usb-devices/1-3/desc"))
+
+    def test_124_cache_warmup(self):
+        back, front = self.added_assign_setup(attachment="front-vm")
+        back.watch_qdb_path = Mock()
+        back.fire_event = Mock()
+
+        async def load():
+            self.ext.on_domain_init_load(back, "domain-load")
+            self.assertIn("sys-usb", self.ext.cache_warmups)
+            # a change arriving during the warm-up is compared with the
+            # initial state, not with an empty cache
+            self.ext.on_qdb_change(back, None, "/qubes-usb-devices")
+            await asyncio.sleep(0.2)
+
+        with mock.patch(
+            "qubesusbproxy.core3ext.QDB_COALESCE_WINDOW", 0
+        ), mock.patch("qubesusbproxy.core3ext.CACHE_STATE_PATH", ""):
+            asyncio.get_event_loop().run_until_complete(load())
+        self.assertEqual(
+            self.ext.devices_cache["sys-usb"], {"1-1": front, "1-2": None}
+        )
+        self.assertEqual(self.ext.cache_warmups, {})
+        self.assertIsNotNone(self.ext.cache_ready)
+        fired = [call.args[0] for call in back.fire_event.call_args_list]
+        self.assertNotIn("device-added:usb", fired)
+        front.fire_event_async.assert_not_called()
+
+    def test_125_restore_cache(self):
+        back, front = self.added_assign_setup(attachment="front-vm")
+        back.watch_qdb_path = Mock()
+        back.fire_event = Mock()
+        front.fire_event_async = AsyncMock()
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+        state_path = os.path.join(state_dir.name, "devices.json")
+        with open(state_path, "w", encoding="utf-8") as state_file:
+            json.dump(
+                {"sys-usb": {"1-1": "front-vm", "1-2": "front-vm"}}, state_file
+            )
+
+        async def load():
+            self.ext.on_domain_init_load(back, "domain-load")
+            await asyncio.sleep(0.2)
+
+        with mock.patch(
+            "qubesusbproxy.core3ext.CACHE_STATE_PATH", state_path
+        ), mock.patch("qubesusbproxy.core3ext.CACHE_STATE_INTERVAL", 0):
+            asyncio.get_event_loop().run_until_complete(load())
+
+        # only 1-2, detached while qubesd wasn't running, is announced
+        front.fire_event_async.assert_called_once()
+        self.assertEqual(
+            front.fire_event_async.call_args[0][0], "device-detach:usb"
+        )
+        self.assertEqual(
+            front.fire_event_async.call_args[1]["port"].port_id, "1-2"
+        )
+        fired = [call.args[0] for call in back.fire_event.call_args_list]
+        self.assertNotIn("device-added:usb", fired)
+        self.assertEqual(
+            self.ext.devices_cache["sys-usb"], {"1-1": front, "1-2": None}
+        )
+        with open(state_path, encoding="utf-8") as state_file:
+            self.assertEqual(
+                json.load(state_file),
+                {"sys-usb": {"1-1": "front-vm", "1-2": None}},
+            )
+
+    def test_126_forget_domain(self):
+        back, front = self.added_assign_setup(attachment="front-vm")
+        back.fire_event = Mock()
+        other = TestVM({}, name="other-vm")
+        other.app = back.app
+        other.fire_event = Mock()
+        other.devices["usb"] = TestDeviceCollection(
+            backend_vm=other, devclass="usb"
+        )
+
+        # a qube without USB devices doesn't get an empty cache entry
+        self.ext.on_qdb_change(other, None, "/qubes-usb-devices")
+        self.assertNotIn("other-vm", self.ext.devices_cache)
+
+        self.ext.on_qdb_change(back, None, "/qubes-usb-devices")
+        self.assertIn("sys-usb", self.ext.devices_cache)
+        self.ext.autoattach_locks[front.uuid] = asyncio.Lock()
+        self.ext.recent_attachments[("sys-usb", "1a0a:badd")] = (
+            front,
+            0,
+            "1-1",
+        )
+        self.ext.suspended_attachments[("sys-usb", "1-1")] = (
+            back,
+            front,
+            "1a0a:badd",
+        )
+        self.ext.on_domain_delete(back.app, "domain-delete", vm=front)
+        self.assertEqual(self.ext.autoattach_locks, {})
+        self.assertEqual(self.ext.recent_attachments, {})
+        self.assertEqual(self.ext.suspended_attachments, {})
+
+        self.ext.on_domain_rename(
+            back, "property-set:name", "name", "sys-usb2", "sys-usb"
+        )
+        self.assertEqual(self.ext.devices_cache, {})
+        self.assertEqual(self.ext.attached_device_ids, {})
+
+    def test_127_device_registry(self):
+        back, front = self.added_assign_setup(attachment="front-vm")
+        back.fire_event = Mock()
+        # qubes loaded, without running backends to warm up
+        self.ext.restored_cache = {}
+        with mock.patch("asyncio.ensure_future"):
+            self.ext.on_qdb_change(back, None, "/qubes-usb-devices")
+        devices = list(self.ext.on_device_list_usb(back, None))
+        self.assertEqual(sorted(d.port_id for d in devices), ["1-1", "1-2"])
+        dev = self.ext.registry.get("sys-usb", "1-1")
+        self.assertIs(
+            list(self.ext.on_device_get_usb(back, None, dev.port_id))[0], dev
+        )
+        self.assertFalse(list(self.ext.on_device_get_usb(back, None, "1-3")))
+        attached = list(self.ext.on_device_list_attached(front, None))
+        self.assertEqual([d.port_id for d, _ in attached], ["1-1"])
+
+        # served from the registry until the backend announces a change
+        qdb = back.untrusted_qdb._data
+        for key in list(qdb):
+            if key.startswith("/qubes-usb-devices/1-2/"):
+                del qdb[key]
+        self.assertEqual(len(list(self.ext.on_device_list_usb(back, None))), 2)
+        with mock.patch("asyncio.ensure_future"):
+            self.ext.on_qdb_change(back, None, "/qubes-usb-devices")
+        devices = list(self.ext.on_device_list_usb(back, None))
+        self.assertEqual([d.port_id for d in devices], ["1-1"])
+        # unchanged devices are kept, with their data already loaded
+        self.assertIs(devices[0], dev)
+
+        self.ext.on_domain_delete(back.app, "domain-delete", vm=front)
+        self.assertFalse(list(self.ext.on_device_list_attached(front, None)))
+
+    def test_128_device_list_change_diff(self):
+        back, _ = self.added_assign_setup(attachment="front-vm")
+        back.fire_event = Mock()
+
+        def list_changes():
+            return [
+                call.kwargs
+                for call in back.fire_event.call_args_list
+                if call.args[0] == "device-list-change:usb"
+            ]
+
+        with mock.patch("asyncio.ensure_future"):
+            self.ext.on_qdb_change(back, None, "/qubes-usb-devices")
+            qdb = back.untrusted_qdb._data
+            del qdb["/qubes-usb-devices/1-1/connected-to"]
+            for key in list(qdb):
+                if key.startswith("/qubes-usb-devices/1-2/"):
+                    del qdb[key]
+            self.ext.on_qdb_change(back, None, "/qubes-usb-devices")
+            # nothing changed
+            self.ext.on_qdb_change(back, None, "/qubes-usb-devices")
+            # other device in the same port, between two checks
+            qdb["/qubes-usb-devices/1-1/desc"] = (
+                b"1a0a:beef USB-IF Other\x20Device 4567"
+            )
+            self.ext.on_qdb_change(back, None, "/qubes-usb-devices")
+
+        self.assertEqual(
+            list_changes(),
+            [
+                {
+                    "added": "1-1 1-2",
+                    "removed": "",
+                    "replaced": "",
+                    "attached": "1-1=front-vm",
+                    "detached": "",
+                    "generation": "1",
+                },
+                {
+                    "added": "",
+                    "removed": "1-2",
+                    "replaced": "",
+                    "attached": "",
+                    "detached": "1-1=front-vm",
+                    "generation": "2",
+                },
+                {
+                    "added": "",
+                    "removed": "",
+                    "replaced": "1-1",
+                    "attached": "",
+                    "detached": "",
+                    "generation": "3",
+                },
+            ],
+        )
+
+    def test_129_generations(self):
+        registry = qubesusbproxy.registry.DeviceRegistry()
+        self.assertEqual(registry.record("sys-usb"), 1)
+        self.assertEqual(registry.record("sys-usb"), 2)
+        # changes of other backends don't count
+        self.assertEqual(registry.record("sys-usb2"), 3)
+        self.assertEqual(registry.record("sys-usb"), 3)
+        # a backend seen again doesn't reuse numbers of its previous run
+        registry.forget("sys-usb")
+        self.assertEqual(registry.record("sys-usb"), 4)
+
+    def test_130_shared_descriptions(self):
+        back, _ = self.added_assign_setup()
+        back.fire_event = Mock()
+        device_class = qubesusbproxy.core3ext.USBDevice
+        device_class.forget_descriptions("sys-usb")
+        self.addCleanup(device_class.forget_descriptions, "sys-usb")
+
+        handled = []
+
+        def handle(vm, path):
+            # parsed before handling the change
+            handled.append(dict(device_class._descriptions.get(vm.name, {})))
+
+        loop = asyncio.get_event_loop()
+        with mock.patch.object(self.ext, "_handle_qdb_change", handle):
+            loop.run_until_complete(
+                self.ext._refresh_and_handle(back, "/qubes-usb-devices")
+            )
+        self.assertEqual(sorted(handled[0]), ["1-1", "1-2"])
+
+        # all objects of a device share its data, parsed once
+        description = device_class.describe(back, "1-2")
+        self.assertIs(description, handled[0]["1-2"])
+        dev = device_class(Port(back, "1-2", "usb"))
+        self.assertEqual(dev.name, description.desc["name"])
+        self.assertEqual(dev.interfaces, list(description.interfaces))
+        with self.assertRaises(TypeError):
+            description.desc["name"] = "other"
+
+        # changed data is parsed again
+        qubesusbproxy.qdb.SNAPSHOTS.forget("sys-usb")
+        back.untrusted_qdb._data["/qubes-usb-devices/1-2/desc"] = (
+            b"1a0a:beef USB-IF Other SN1"
+        )
+        description = device_class.describe(back, "1-2")
+        self.assertEqual(description.desc["serial"], "SN1")
+
+        # parsing in a thread uses only the snapshot data, never QubesDB
+        back.untrusted_qdb.read = Mock(side_effect=AssertionError)
+        back.untrusted_qdb.list = Mock(side_effect=AssertionError)
+        data = {"/qubes-usb-devices/1-2/desc": b"1a0a:beef USB-IF Other SN2"}
+        self.assertEqual(
+            qubesusbproxy.core3ext._describe_all(back, ["1-2"], data), 1
+        )
+        description = device_class._descriptions["sys-usb"]["1-2"]
+        self.assertEqual(description.desc["serial"], "SN2")
+        self.assertIsNone(description.interfaces)
+
+    def test_131_unresponsive_backend_without_snapshot(self):
+        back, _ = self.added_assign_setup(attachment="front-vm")
+        back.watch_qdb_path = Mock()
+        back.fire_event = Mock()
+        unblock = threading.Event()
+        self.addCleanup(qubesusbproxy.qdb.SNAPSHOTS.forget, "sys-usb")
+        self.addCleanup(unblock.set)
+        list_keys = back.untrusted_qdb.list
+        direct_reads = []
+
+        def hanging_list(prefix):
+            if threading.current_thread() is threading.main_thread():
+                # on the event loop, it would block qubesd
+                direct_reads.append(prefix)
+            unblock.wait(5)
+            return list_keys(prefix)
+
+        back.untrusted_qdb.list = hanging_list
+
+        async def load():
+            self.ext.on_domain_init_load(back, "domain-load")
+            await asyncio.sleep(0.2)
+            self.ext.on_qdb_change(back, None, "/qubes-usb-devices")
+            await asyncio.sleep(0.2)
+
+        with mock.patch.object(
+            qubesusbproxy.qdb.SNAPSHOTS, "deadline", 0.05
+        ), mock.patch(
+            "qubesusbproxy.core3ext.QDB_COALESCE_WINDOW", 0
+        ), mock.patch(
+            "qubesusbproxy.core3ext.CACHE_STATE_PATH", ""
+        ):
+            asyncio.get_event_loop().run_until_complete(load())
+        self.assertEqual(direct_reads, [])
+        # nothing is known about its devices until a refresh succeeds
+        self.assertNotIn("sys-usb", self.ext.devices_cache)
+        self.assertFalse(self.ext.registry.tracks("sys-usb"))
+        fired = [call.args[0] for call in back.fire_event.call_args_list]
+        self.assertNotIn("device-added:usb", fired)
+
+    def test_132_cache_warmup_failure(self):
+        back, front = self.added_assign_setup(attachment="front-vm")
+        back.watch_qdb_path = Mock()
+        back.fire_event = Mock()
+        front.fire_event_async = AsyncMock()
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+        state_path = os.path.join(state_dir.name, "devices.json")
+        with open(state_path, "w", encoding="utf-8") as state_file:
+            json.dump({"sys-usb": {"1-1": "front-vm", "1-2": None}}, state_file)
+
+        async def load():
+            with mock.patch.object(
+                self.ext, "_index_devices", side_effect=RuntimeError("boom")
+            ):
+                self.ext.on_domain_init_load(back, "domain-load")
+                await asyncio.sleep(0.2)
+            self.ext.on_qdb_change(back, None, "/qubes-usb-devices")
+            await asyncio.sleep(0.2)
+
+        with mock.patch(
+            "qubesusbproxy.core3ext.CACHE_STATE_PATH", state_path
+        ), mock.patch(
+            "qubesusbproxy.core3ext.QDB_COALESCE_WINDOW", 0
+        ), mock.patch(
+            "qubesusbproxy.core3ext.CACHE_STATE_INTERVAL", 0
+        ):
+            asyncio.get_event_loop().run_until_complete(load())
+
+        back.log.warning.assert_called_once()
+        self.assertEqual(self.ext.cache_warmups, {})
+        # the restored state is the baseline, nothing is re-announced
+        fired = [call.args[0] for call in back.fire_event.call_args_list]
+        self.assertNotIn("device-added:usb", fired)
+        front.fire_event_async.assert_not_called()
+        self.assertEqual(
+            self.ext.devices_cache["sys-usb"], {"1-1": front, "1-2": None}
+        )
+
 
 def list_tests():
     tests = [TC_00_USBProxy]